@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+Synthetic-portfolio benchmark for the fetch.py sync pipeline.
+
+Generates a Wealthsimple-shaped cassette at the requested scale, replays it
+through fetch.main() against a local PostgreSQL that has the Prisma schema
+loaded, and reports per-stage wall time, rows/sec, DB round trips and peak
+RSS. Activities are recorded as bookmarked pages of --page-size, so replay
+pages and stops at the incremental cutoff as a live sync would. Every run
+is appended as one JSON line to the results file so runs can be compared
+over time.
+
+The target database is wiped before the first run, so it must never be the
+production DATABASE_URL.
+
+Usage:
+    python bench.py --database-url postgresql://localhost/ws_bench --push-schema
+    python bench.py --accounts 6 --positions 40 --years 10 --activities 20000
+    python bench.py --runs 2 --fetch-args "--concurrency 6 --batch-size 1000"
+    python bench.py --normalize-only --activities 100000   # CPU and heap of normalizing
+"""
+
+import argparse
+import gc
+import gzip
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+import psycopg2
+import psycopg2.extensions
+
+SYNC_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(SYNC_DIR, "..", "app")
+
+ACCOUNT_TYPES = ["ca_tfsa", "ca_rrsp", "ca_non_registered", "ca_fhsa", "us_non_registered", "ca_resp"]
+TRADE_TYPES = ["diy_buy", "diy_sell", "deposit", "withdrawal", "fee", "interest"]
+# get_historical_financials windows, as fetch.HISTORY_WINDOWS; "1y" carries the whole history.
+HISTORY_WINDOWS = [("1d", 1), ("1w", 7), ("1m", 28), ("3m", 89)]
+TABLES = ["dividends", "activities", "account_snapshots", "positions", "securities",
+          "accounts", "sync_logs", "portfolio_daily", "dividend_monthly_totals",
+          "account_type_allocations"]
+
+
+# ---------------------------------------------------------------------------
+# Synthetic data
+# ---------------------------------------------------------------------------
+
+def money(amount: float, currency: str = "CAD") -> dict:
+    return {"amount": f"{amount:.2f}", "currency": currency}
+
+
+def generate_cassette(path: str, accounts: int, positions: int, years: int,
+                      activities: int, dividend_share: float, seed: int, page_size: int):
+    """Write a replayable cassette in the RecordingClient format.
+
+    Calls are recorded with the arguments fetch.py sends, so replay matches
+    them exactly: one history entry per window and activities as
+    ``page_size`` pages chained by bookmarks.
+    """
+    rng = random.Random(seed)
+    today = date.today()
+    now = datetime.now()
+    symbols = [f"SYM{i:04d}" for i in range(max(positions, 1))]
+    per_account = activities // max(accounts, 1)
+
+    def entry(method, args, response, **kwargs):
+        return json.dumps({"method": method, "args": args, "kwargs": kwargs, "response": response}) + "\n"
+
+    account_rows = [
+        {
+            "id": f"bench-{i}",
+            "accountType": ACCOUNT_TYPES[i % len(ACCOUNT_TYPES)],
+            "nickname": f"Bench {i}",
+            "currency": "CAD",
+            "status": "open",
+            "currentBalance": money(rng.uniform(1e4, 5e5)),
+            "buyingPower": money(rng.uniform(0, 5e3)),
+            "deposits": money(rng.uniform(1e4, 2e5)),
+            "withdrawals": money(rng.uniform(0, 1e4)),
+        }
+        for i in range(accounts)
+    ]
+
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write(entry("get_accounts", [], {"results": account_rows}))
+
+        for acc in account_rows:
+            held = rng.sample(symbols, min(positions, len(symbols)))
+            f.write(entry("get_positions", [acc["id"]], {"results": [
+                {
+                    "stock": {"symbol": sym, "name": f"{sym} Corp"},
+                    "quantity": f"{rng.uniform(1, 500):.4f}",
+                    "bookValue": money(rng.uniform(100, 2e4)),
+                    "marketValue": money(rng.uniform(100, 2e4)),
+                    "currency": "CAD",
+                }
+                for sym in held
+            ]}))
+
+            value = rng.uniform(1e3, 1e4)
+            history = []
+            for d in range(years * 365, -1, -1):
+                value *= 1 + rng.gauss(0.0003, 0.01)
+                history.append({
+                    "date": (today - timedelta(days=d)).isoformat(),
+                    "value": money(value),
+                    "deposits": money(rng.choice([0, 0, 0, 500])),
+                    "withdrawals": money(0),
+                    "earnings": money(value * 0.0003),
+                })
+            f.write(entry("get_historical_financials", [acc["id"], "1y"], {"results": history}))
+            for window, days in HISTORY_WINDOWS:
+                f.write(entry("get_historical_financials", [acc["id"], window],
+                              {"results": history[-(days + 1):]}))
+
+            acts = synthetic_activities(rng, acc["id"], per_account, held or symbols,
+                                        years, dividend_share, now)
+            for n, start in enumerate(range(0, max(len(acts), 1), page_size)):
+                page = {"results": acts[start:start + page_size]}
+                if start + page_size < len(acts):
+                    page["bookmark"] = f"{acc['id']}-page-{n + 1}"
+                kwargs = {"limit": page_size}
+                if n:
+                    kwargs["bookmark"] = f"{acc['id']}-page-{n}"
+                f.write(entry("get_activities", [acc["id"]], page, **kwargs))
+
+
+def synthetic_activities(rng: random.Random, account_id: str, count: int, symbols: list[str],
+                         years: int, dividend_share: float, now: datetime) -> list[dict]:
+    """Return ``count`` raw WS activities for one account, newest first."""
+    span_minutes = max(years, 1) * 365 * 24 * 60
+    acts = []
+    for k in range(count):
+        occurred = now - timedelta(minutes=rng.randrange(span_minutes))
+        if rng.random() < dividend_share:
+            act_type, sym = "dividend", rng.choice(symbols)
+        else:
+            act_type = rng.choice(TRADE_TYPES)
+            sym = rng.choice(symbols) if act_type.startswith("diy_") else None
+        acts.append({
+            "id": f"{account_id}-act-{k}",
+            "type": act_type,
+            "symbol": sym,
+            "description": f"{act_type} {sym or ''}".strip(),
+            "quantity": f"{rng.uniform(1, 50):.4f}" if sym and act_type != "dividend" else None,
+            "price": money(rng.uniform(5, 300)) if sym and act_type != "dividend" else None,
+            "amount": money(rng.uniform(1, 5e3)),
+            "occurredAt": occurred.isoformat(timespec="seconds"),
+        })
+    acts.sort(key=lambda a: a["occurredAt"], reverse=True)
+    return acts
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+class Probe:
+    """Round-trip counter shared by the patched connections of both engines."""
+
+    round_trips = 0
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        Probe.round_trips += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        Probe.round_trips += len(vars_list)
+        return super().executemany(query, vars_list)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    def commit(self):
+        Probe.round_trips += 1
+        super().commit()
+
+
+def count_async_round_trips():
+    """Count round trips on psycopg 3 connections too, as --engine async uses.
+
+    executemany() is pipelined into one round trip, so it counts once.
+    """
+    try:
+        import psycopg
+    except ImportError:
+        return
+
+    def counted(method):
+        async def wrapper(*args, **kwargs):
+            Probe.round_trips += 1
+            return await method(*args, **kwargs)
+        return wrapper
+
+    for cls, names in ((psycopg.AsyncCursor, ("execute", "executemany")),
+                       (psycopg.AsyncConnection, ("commit",))):
+        for name in names:
+            setattr(cls, name, counted(getattr(cls, name)))
+
+
+def run_pipeline(database_url: str, cassette: str, fetch_args: list[str], results):
+    """Child-process entry point: replay the cassette through fetch.main()."""
+    sys.path.insert(0, SYNC_DIR)
+    os.environ["DATABASE_URL"] = database_url
+    import fetch
+
+    fetch.get_db_connection = lambda: psycopg2.connect(
+        database_url, connection_factory=CountingConnection, cursor_factory=CountingCursor
+    )
+    count_async_round_trips()
+
+    # fetch.py prints a line per row; keep that out of the timings and the report.
+    sys.stdout = open(os.devnull, "w")
+    sys.argv = ["fetch.py", "--replay", cassette, "--metrics-bytes", *fetch_args]
+    status = "success"
+    started = time.perf_counter()
+    try:
+        fetch.main()
+    except SystemExit as e:
+        status = "success" if not e.code else "error"
+    except Exception:
+        status = "error"
+        traceback.print_exc()
+    elapsed = time.perf_counter() - started
+
+    results.put({
+        "status": status,
+        "elapsed_s": round(elapsed, 4),
+        "db_round_trips": Probe.round_trips,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+
+
+def bench_normalize(activities: int, positions: int, years: int,
+                    dividend_share: float, seed: int) -> dict:
+    """Time normalize_activities() in-process on synthetic raw activities.
+
+    CPU time is the best of three untraced passes. A final pass under
+    tracemalloc keeps every normalized row, reporting the peak and retained
+    heap and the number of live allocations those rows cost.
+    """
+    sys.path.insert(0, SYNC_DIR)
+    import fetch
+
+    rng = random.Random(seed)
+    symbols = [f"SYM{i:04d}" for i in range(max(positions, 1))]
+    raw = synthetic_activities(rng, "bench-0", activities, symbols, years, dividend_share, datetime.now())
+    acc = next(fetch.normalize_accounts([{"id": "bench-0", "accountType": "ca_tfsa", "currency": "CAD"}]))
+
+    def normalize():
+        return list(fetch.normalize_activities(acc, raw))
+
+    cpu = None
+    for _ in range(3):
+        gc.collect()
+        started = time.process_time()
+        normalize()
+        elapsed = time.process_time() - started
+        cpu = elapsed if cpu is None else min(cpu, elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    rows = normalize()
+    retained, peak = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+
+    return {
+        "rows": len(rows),
+        "cpu_s": round(cpu, 4),
+        "activities_per_s": round(activities / cpu, 1) if cpu else None,
+        "retained_kb": round(retained / 1024, 1),
+        "peak_kb": round(peak / 1024, 1),
+        "retained_blocks": blocks,
+    }
+
+
+def reset_database(database_url: str, push_schema: bool):
+    if push_schema:
+        subprocess.run(
+            ["npx", "prisma", "db", "push", "--force-reset", "--accept-data-loss"],
+            cwd=APP_DIR, env={**os.environ, "DATABASE_URL": database_url}, check=True,
+        )
+        return
+    conn = psycopg2.connect(database_url)
+    with conn, conn.cursor() as cur:
+        cur.execute(f"TRUNCATE {', '.join(TABLES)} CASCADE")
+    conn.close()
+
+
+def latest_sync_log(database_url: str) -> tuple[dict, dict | None]:
+    """Return the row counts and stored metrics of the most recent sync."""
+    conn = psycopg2.connect(database_url)
+    with conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT "accountsCount", "positionsCount", "snapshotsCount",
+                   "activitiesCount", "dividendsCount", metrics
+            FROM sync_logs ORDER BY "startedAt" DESC LIMIT 1
+        """)
+        row = cur.fetchone() or (0, 0, 0, 0, 0, None)
+    conn.close()
+    return dict(zip(["accounts", "positions", "snapshots", "activities", "dividends"], row)), row[5]
+
+
+def fetch_page_size(fetch_args: list[str]) -> int:
+    """The --page-size fetch.py will run with, so the cassette's pages match its requests."""
+    sys.path.insert(0, SYNC_DIR)
+    import fetch
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--page-size", type=int, default=fetch.ACTIVITY_PAGE_SIZE)
+    return parser.parse_known_args(fetch_args)[0].page_size
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SYNC_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sync pipeline on synthetic data")
+    parser.add_argument("--database-url", help="Local benchmark database (or BENCH_DATABASE_URL)",
+                        type=str, default=os.environ.get("BENCH_DATABASE_URL"))
+    parser.add_argument("--push-schema", help="Reset the database with `prisma db push` first",
+                        action="store_true")
+    parser.add_argument("--accounts", type=int, default=6)
+    parser.add_argument("--positions", help="Positions per account", type=int, default=40)
+    parser.add_argument("--years", help="Years of daily history per account", type=int, default=5)
+    parser.add_argument("--activities", help="Activities across all accounts", type=int, default=20000)
+    parser.add_argument("--dividend-share", help="Fraction of activities that are dividends",
+                        type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--runs", help="Runs against the same data; the first is cold",
+                        type=int, default=1)
+    parser.add_argument("--fetch-args", help="Extra fetch.py arguments, e.g. '--concurrency 6'",
+                        type=str, default="")
+    parser.add_argument("--output", help="JSON-lines results file (default bench_results.jsonl)",
+                        type=str, default="bench_results.jsonl")
+    parser.add_argument("--normalize-only", help="Only time normalizing --activities raw activities "
+                                                 "in-process; no database needed",
+                        action="store_true")
+    args = parser.parse_args()
+
+    if args.normalize_only:
+        result = bench_normalize(args.activities, args.positions, args.years,
+                                 args.dividend_share, args.seed)
+        record = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "run": "normalize",
+            "scale": {"activities": args.activities, "dividend_share": args.dividend_share,
+                      "seed": args.seed},
+            **result,
+        }
+        with open(args.output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        print(f"Normalized {args.activities} activities into {result['rows']} rows")
+        print(f"  CPU time:        {result['cpu_s']}s ({result['activities_per_s']} activities/s)")
+        print(f"  Retained heap:   {result['retained_kb']} KB in {result['retained_blocks']} blocks")
+        print(f"  Peak heap:       {result['peak_kb']} KB")
+        print(f"\nResults appended to {args.output}")
+        return
+
+    if not args.database_url:
+        print("ERROR: pass --database-url or set BENCH_DATABASE_URL (never the production database)")
+        sys.exit(1)
+
+    scale = {
+        "accounts": args.accounts, "positions": args.positions, "years": args.years,
+        "activities": args.activities, "dividend_share": args.dividend_share, "seed": args.seed,
+    }
+    fetch_args = shlex.split(args.fetch_args)
+    page_size = fetch_page_size(fetch_args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cassette = os.path.join(tmp, "bench.ndjson.gz")
+        print(f"Generating synthetic cassette: {scale}")
+        generate_cassette(cassette, args.accounts, args.positions, args.years,
+                          args.activities, args.dividend_share, args.seed, page_size)
+
+        reset_database(args.database_url, args.push_schema)
+
+        ctx = multiprocessing.get_context("spawn")
+        for run in range(args.runs):
+            results = ctx.Queue()
+            proc = ctx.Process(target=run_pipeline,
+                               args=(args.database_url, cassette, fetch_args, results))
+            proc.start()
+            metrics = None
+            while metrics is None:
+                try:
+                    metrics = results.get(timeout=1)
+                except queue.Empty:
+                    if not proc.is_alive():
+                        break
+            proc.join()
+            if metrics is None:
+                print(f"ERROR: benchmark run {run + 1} exited with code {proc.exitcode}")
+                sys.exit(1)
+
+            rows, sync_metrics = latest_sync_log(args.database_url)
+            # Stage times come from the engine's own metrics, so both engines report them.
+            metrics["stages_s"] = (sync_metrics or {}).get("stages", {})
+            total_rows = sum(rows.values())
+            record = {
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "revision": git_revision(),
+                "run": "cold" if run == 0 else "warm",
+                "scale": scale,
+                "fetch_args": fetch_args,
+                "rows": rows,
+                "rows_per_s": round(total_rows / metrics["elapsed_s"], 1) if metrics["elapsed_s"] else None,
+                **metrics,
+                "sync_metrics": sync_metrics,
+            }
+            with open(args.output, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+            print(f"\n{'='*50}")
+            print(f"Run {run + 1} ({record['run']}): {metrics['status']} in {metrics['elapsed_s']}s")
+            for stage, seconds in metrics["stages_s"].items():
+                print(f"  {stage:<28} {seconds:>8.3f}s")
+            print(f"  Rows written:   {total_rows} ({record['rows_per_s']} rows/s)")
+            print(f"  DB round trips: {metrics['db_round_trips']}")
+            print(f"  Peak RSS:       {metrics['peak_rss_mb']} MB")
+            print(f"{'='*50}")
+
+    print(f"\nResults appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,22 +8,330 @@ and upserts into Neon PostgreSQL for the Next.js dashboard to read.
 Usage:
     python fetch.py                  # Interactive TOTP prompt
     python fetch.py --totp 123456    # Pass TOTP code directly
+    python fetch.py --batch-size 1000  # Rows per multi-row upsert
+    python fetch.py --page-size 500  # Activities per API page (memory stays flat)
+    python fetch.py --concurrency 6  # Fetch all accounts in parallel
+    python fetch.py --rate 1 --max-rate 5        # Pace API calls (adapts to 429s)
+    python fetch.py --full           # Rewrite full history, not just recent days
+    python fetch.py --backfill --concurrency 4   # Fetch all history in resumable windows
+    python fetch.py --resume         # Retry what the last failed sync left undone
+    python fetch.py --security-ttl 168           # Refresh security metadata weekly
+    python fetch.py --recompute-frequencies      # Rederive every dividend from stored activities
+    python fetch.py --record run.ndjson.gz       # Save every API response
+    python fetch.py --replay run.ndjson.gz       # Sync from a recording, no login
+    python fetch.py --metrics-file metrics.json  # Also write timings to a file
+    python fetch.py --metrics-bytes              # Also measure API response sizes
+    python fetch.py --export exports/            # Also write touched partitions to Parquet
+    python fetch.py --quotes-only                # Reprice holdings from daily closes, no login
+    python fetch.py --quotes-only --quotes-file quotes.json  # ...from a file of quotes
+    python fetch.py --log-level DEBUG            # Print every synced row
+    python fetch.py --daemon         # Sync on a schedule, reusing the session
+    python fetch.py --profiles profiles.json --max-profiles 4  # Sync several logins in parallel
+    python fetch.py --engine async --concurrency 6  # Overlap all stages (psycopg 3)
 """
 
 import argparse
+import asyncio
+import gzip
+import importlib.util
 import json
+import logging
 import os
+import queue
+import random
+import re
 import sys
+import threading
+import time
 import traceback
-from datetime import datetime, date, timedelta
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta, time as dt_time
 from decimal import Decimal
+from typing import TYPE_CHECKING
+from zoneinfo import ZoneInfo
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    import pyarrow
+
 load_dotenv()
 
+logger = logging.getLogger("fetch")
+
+# ---------------------------------------------------------------------------
+# Instrumentation
+# ---------------------------------------------------------------------------
+
+# Summary tables derived from the synced ones. Their writes are kept apart
+# from the synced rows, so the changed-row counts only reflect synced data.
+AGGREGATE_TABLES = {"portfolio_daily"}
+
+# The sync's own progress and cache tables: timed in ``writes`` like any
+# table, but left out of the changed-row counts.
+BOOKKEEPING_TABLES = {"sync_checkpoints", "backfill_windows", "quote_cache"}
+
+
+class SyncMetrics:
+    """Wall time, call counts, bytes received and rows written for one sync run.
+
+    Thread-safe, so API calls made from the prefetch pool can report into it.
+    Writes to AGGREGATE_TABLES are kept in ``aggregates``, not ``writes``.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: dict[str, float] = {}
+        self.api: dict[str, dict] = {}
+        self.writes: dict[str, dict] = {}
+        self.aggregates: dict[str, dict] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def record_api(self, method: str, seconds: float, nbytes: int, error: bool = False):
+        with self.lock:
+            m = self._api(method)
+            m["calls"] += 1
+            m["errors"] += int(error)
+            m["seconds"] += seconds
+            m["bytes"] += nbytes
+
+    def record_retry(self, method: str, throttled: bool):
+        with self.lock:
+            m = self._api(method)
+            m["retries"] += 1
+            m["throttled"] += int(throttled)
+
+    def _api(self, method: str) -> dict:
+        return self.api.setdefault(method, {
+            "calls": 0, "errors": 0, "retries": 0, "throttled": 0, "seconds": 0.0, "bytes": 0,
+        })
+
+    def record_write(self, table: str, rows: int, seconds: float, inserted: int = 0,
+                     updated: int = 0, deleted: int = 0):
+        with self.lock:
+            tables = self.aggregates if table in AGGREGATE_TABLES else self.writes
+            m = tables.setdefault(table, {
+                "flushes": 0, "rows": 0, "seconds": 0.0,
+                "inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0,
+            })
+            m["flushes"] += 1
+            m["rows"] += rows
+            m["seconds"] += seconds
+            m["inserted"] += inserted
+            m["updated"] += updated
+            m["unchanged"] += rows - inserted - updated
+            m["deleted"] += deleted
+
+    def write_totals(self) -> dict[str, int]:
+        """Inserted, updated and unchanged row counts summed over the synced tables."""
+        with self.lock:
+            synced = [m for table, m in self.writes.items() if table not in BOOKKEEPING_TABLES]
+            return {key: sum(m[key] for m in synced) for key in ("inserted", "updated", "unchanged")}
+
+    def as_dict(self) -> dict:
+        def rounded(d):
+            return {k: round(v, 4) if isinstance(v, float) else v for k, v in d.items()}
+
+        with self.lock:
+            return {
+                "stages": rounded(self.stages),
+                "api": {k: rounded(v) for k, v in self.api.items()},
+                "writes": {k: rounded(v) for k, v in self.writes.items()},
+                "aggregates": {k: rounded(v) for k, v in self.aggregates.items()},
+            }
+
+
+class InstrumentedClient:
+    """Wrap a WS client and report the time of every get_* call.
+
+    The client hands back decoded JSON, so sizing a response means encoding
+    it again. That doubles the serialization work on large pages, so it is
+    only done with ``count_bytes``; otherwise bytes are reported as 0.
+    """
+
+    def __init__(self, ws, metrics: SyncMetrics, count_bytes: bool = False):
+        self.ws = ws
+        self.metrics = metrics
+        self.count_bytes = count_bytes
+
+    def __getattr__(self, name):
+        attr = getattr(self.ws, name)
+        if not name.startswith("get_"):
+            return attr
+
+        def call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                self.metrics.record_api(name, time.perf_counter() - started, 0, error=True)
+                raise
+            elapsed = time.perf_counter() - started
+            nbytes = len(json.dumps(result, default=str)) if self.count_bytes else 0
+            self.metrics.record_api(name, elapsed, nbytes)
+            return result
+
+        return call
+
+
+# ---------------------------------------------------------------------------
+# Request scheduling
+# ---------------------------------------------------------------------------
+
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+TRANSIENT_ERROR_NAMES = {"ConnectionError", "Timeout", "ConnectTimeout", "ReadTimeout", "TimeoutError"}
+# An HTTP status quoted in an error message, for clients that keep no status code.
+STATUS_IN_TEXT = re.compile(r"\b(429|50[0234])\b")
+
+
+def classify_api_error(exc: Exception) -> str | None:
+    """Return "throttled" for HTTP 429, "transient" for 5xx and network errors, else None.
+
+    The status code on the error or its response is trusted first. Only
+    without one is the message searched for a status or a known phrase.
+    """
+    status = getattr(exc, "status_code", None)
+    if not isinstance(status, int):
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    if not isinstance(status, int):
+        match = STATUS_IN_TEXT.search(str(exc))
+        status = int(match.group(1)) if match else None
+    text = str(exc).lower()
+    if status == 429 or "too many requests" in text or "rate limit" in text:
+        return "throttled"
+    if (status is not None and 500 <= status < 600) or type(exc).__name__ in TRANSIENT_ERROR_NAMES:
+        return "transient"
+    if any(s in text for s in ("internal server error", "bad gateway", "service unavailable", "timed out")):
+        return "transient"
+    return None
+
+
+def retry_after(exc: Exception) -> float | None:
+    """Seconds from a Retry-After header on the error's response, if the client kept one."""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        return max(float(headers.get("Retry-After")), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """Route every get_* call on a WS client through one rate-limited gate.
+
+    Calls draw from a token bucket refilled at ``rate`` per second, and at
+    most ``max_in_flight`` run at once. Throttled (429) and transient (5xx,
+    network) failures are retried with jittered exponential backoff, up to
+    ``max_retries`` per call and ``retry_budget`` per run. A 429 also pauses
+    every caller and halves the rate; each success then raises it again
+    towards ``max_rate``. Other errors propagate unchanged.
+    """
+
+    def __init__(self, ws, rate: float, max_rate: float, max_in_flight: int,
+                 max_retries: int, retry_budget: int, metrics: SyncMetrics | None = None):
+        self.ws = ws
+        self.rate = rate
+        self.min_rate = min(rate, 0.2)
+        self.max_rate = max(rate, max_rate)
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self.metrics = metrics
+        self.cond = threading.Condition()
+        self.tokens = 1.0
+        self.refilled = time.monotonic()
+        self.paused_until = 0.0
+        self.in_flight = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.ws, name)
+        if not name.startswith("get_"):
+            return attr
+
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                self._acquire()
+                try:
+                    result = attr(*args, **kwargs)
+                except Exception as e:
+                    kind = classify_api_error(e)
+                    delay = self._release(kind or "error", attempt, retry_after(e))
+                    if kind is None or attempt >= self.max_retries or not self._spend_retry():
+                        raise
+                    attempt += 1
+                    if self.metrics:
+                        self.metrics.record_retry(name, throttled=kind == "throttled")
+                    logger.info("  %s %s, retry %d in %.1fs (rate %.2f/s)",
+                                name, kind, attempt, delay, self.rate)
+                    time.sleep(delay)
+                    continue
+                self._release(None, attempt)
+                return result
+
+        return call
+
+    def _acquire(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.max_in_flight, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= self.max_in_flight:
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                self.cond.wait(wait)
+
+    def _release(self, kind: str | None, attempt: int, hint: float | None = None) -> float:
+        """Return the call's slot, adapt the rate and give the delay before a retry."""
+        delay = hint if hint is not None else backoff_delay(attempt)
+        with self.cond:
+            self.in_flight -= 1
+            if kind is None:
+                # Additive increase: about +1 request/s per second of clean calls.
+                self.rate = min(self.max_rate, self.rate + 1 / max(self.rate, 1))
+            elif kind == "throttled":
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                self.tokens = 0.0
+            self.cond.notify_all()
+        return delay
+
+    def _spend_retry(self) -> bool:
+        with self.cond:
+            if self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+            return True
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with jitter: half the step fixed, half random."""
+    step = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return step / 2 + random.uniform(0, step / 2)
+
+
 # ---------------------------------------------------------------------------
 # Database helpers
 # ---------------------------------------------------------------------------
@@ -37,14 +345,43 @@ def get_db_connection():
     return psycopg2.connect(url)
 
 
-def upsert_account(cur, account: dict):
-    """Upsert a single WS account."""
-    cur.execute("""
+def get_db_pool(max_connections: int = 2):
+    """Open a small pool of Neon connections with TCP keepalives, for the daemon."""
+    url = os.environ.get("DATABASE_URL")
+    if not url:
+        print("ERROR: DATABASE_URL not set in .env")
+        sys.exit(1)
+    return psycopg2.pool.SimpleConnectionPool(
+        1, max_connections, url, keepalives=1, keepalives_idle=60, keepalives_interval=10,
+    )
+
+
+def checkout_connection(pool):
+    """Take a live connection from the pool, replacing any the server has dropped."""
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+    except psycopg2.Error:
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+
+# Multi-row upsert statements, one per table. Each entry is the statement
+# (with a single VALUES %s placeholder for execute_values), the per-row
+# template, and the conflict key used to deduplicate rows within a batch.
+# Conflicting rows are only rewritten when a value actually changed, and
+# RETURNING (xmax = 0) tells inserted rows apart from updated ones; rows
+# that return nothing were unchanged. Any further RETURNING columns are
+# collected in BulkWriter.touched so later steps can be scoped to them.
+UPSERTS = {
+    "accounts": (
+        """
         INSERT INTO accounts (id, type, nickname, currency, status, netliquidation,
                               "buyingPower", "totalDeposits", "totalWithdrawals", "updatedAt")
-        VALUES (%(id)s, %(type)s, %(nickname)s, %(currency)s, %(status)s,
-                %(netliquidation)s, %(buying_power)s, %(total_deposits)s,
-                %(total_withdrawals)s, NOW())
+        VALUES %s
         ON CONFLICT (id) DO UPDATE SET
             type = EXCLUDED.type,
             nickname = EXCLUDED.nickname,
@@ -55,18 +392,26 @@ def upsert_account(cur, account: dict):
             "totalDeposits" = EXCLUDED."totalDeposits",
             "totalWithdrawals" = EXCLUDED."totalWithdrawals",
             "updatedAt" = NOW()
-    """, account)
-
-
-def upsert_position(cur, position: dict):
-    """Upsert a single position."""
-    cur.execute("""
+        WHERE (accounts.type, accounts.nickname, accounts.currency, accounts.status,
+               accounts.netliquidation, accounts."buyingPower", accounts."totalDeposits",
+               accounts."totalWithdrawals")
+          IS DISTINCT FROM
+              (EXCLUDED.type, EXCLUDED.nickname, EXCLUDED.currency, EXCLUDED.status,
+               EXCLUDED.netliquidation, EXCLUDED."buyingPower", EXCLUDED."totalDeposits",
+               EXCLUDED."totalWithdrawals")
+        RETURNING (xmax = 0)
+        """,
+        """(%(id)s, %(type)s, %(nickname)s, %(currency)s, %(status)s,
+            %(netliquidation)s, %(buying_power)s, %(total_deposits)s,
+            %(total_withdrawals)s, NOW())""",
+        ("id",),
+    ),
+    "positions": (
+        """
         INSERT INTO positions (id, "accountId", "securityId", symbol, name, quantity,
                                "bookValue", "marketValue", "gainLoss", "gainLossPct",
                                currency, "updatedAt")
-        VALUES (%(id)s, %(account_id)s, %(security_id)s, %(symbol)s, %(name)s,
-                %(quantity)s, %(book_value)s, %(market_value)s, %(gain_loss)s,
-                %(gain_loss_pct)s, %(currency)s, NOW())
+        VALUES %s
         ON CONFLICT ("accountId", symbol) DO UPDATE SET
             "securityId" = EXCLUDED."securityId",
             name = EXCLUDED.name,
@@ -77,31 +422,46 @@ def upsert_position(cur, position: dict):
             "gainLossPct" = EXCLUDED."gainLossPct",
             currency = EXCLUDED.currency,
             "updatedAt" = NOW()
-    """, position)
-
-
-def upsert_snapshot(cur, snapshot: dict):
-    """Upsert an account snapshot."""
-    cur.execute("""
+        WHERE (positions."securityId", positions.name, positions.quantity,
+               positions."bookValue", positions."marketValue", positions."gainLoss",
+               positions."gainLossPct", positions.currency)
+          IS DISTINCT FROM
+              (EXCLUDED."securityId", EXCLUDED.name, EXCLUDED.quantity,
+               EXCLUDED."bookValue", EXCLUDED."marketValue", EXCLUDED."gainLoss",
+               EXCLUDED."gainLossPct", EXCLUDED.currency)
+        RETURNING (xmax = 0)
+        """,
+        """(%(id)s, %(account_id)s, %(security_id)s, %(symbol)s, %(name)s,
+            %(quantity)s, %(book_value)s, %(market_value)s, %(gain_loss)s,
+            %(gain_loss_pct)s, %(currency)s, NOW())""",
+        ("account_id", "symbol"),
+    ),
+    "account_snapshots": (
+        """
         INSERT INTO account_snapshots (id, "accountId", date, netliquidation,
                                         deposits, withdrawals, earnings)
-        VALUES (%(id)s, %(account_id)s, %(date)s, %(netliquidation)s,
-                %(deposits)s, %(withdrawals)s, %(earnings)s)
+        VALUES %s
         ON CONFLICT ("accountId", date) DO UPDATE SET
             netliquidation = EXCLUDED.netliquidation,
             deposits = EXCLUDED.deposits,
             withdrawals = EXCLUDED.withdrawals,
             earnings = EXCLUDED.earnings
-    """, snapshot)
-
-
-def upsert_activity(cur, activity: dict):
-    """Upsert an activity."""
-    cur.execute("""
+        WHERE (account_snapshots.netliquidation, account_snapshots.deposits,
+               account_snapshots.withdrawals, account_snapshots.earnings)
+          IS DISTINCT FROM
+              (EXCLUDED.netliquidation, EXCLUDED.deposits,
+               EXCLUDED.withdrawals, EXCLUDED.earnings)
+        RETURNING (xmax = 0), "accountId", date
+        """,
+        """(%(id)s, %(account_id)s, %(date)s, %(netliquidation)s,
+            %(deposits)s, %(withdrawals)s, %(earnings)s)""",
+        ("account_id", "date"),
+    ),
+    "activities": (
+        """
         INSERT INTO activities (id, "accountId", type, symbol, description,
                                 quantity, price, amount, currency, "occurredAt")
-        VALUES (%(id)s, %(account_id)s, %(type)s, %(symbol)s, %(description)s,
-                %(quantity)s, %(price)s, %(amount)s, %(currency)s, %(occurred_at)s)
+        VALUES %s
         ON CONFLICT (id) DO UPDATE SET
             type = EXCLUDED.type,
             symbol = EXCLUDED.symbol,
@@ -111,55 +471,482 @@ def upsert_activity(cur, activity: dict):
             amount = EXCLUDED.amount,
             currency = EXCLUDED.currency,
             "occurredAt" = EXCLUDED."occurredAt"
-    """, activity)
-
-
-def upsert_dividend(cur, dividend: dict):
-    """Upsert a dividend record."""
-    cur.execute("""
+        WHERE (activities.type, activities.symbol, activities.description,
+               activities.quantity, activities.price, activities.amount,
+               activities.currency, activities."occurredAt")
+          IS DISTINCT FROM
+              (EXCLUDED.type, EXCLUDED.symbol, EXCLUDED.description,
+               EXCLUDED.quantity, EXCLUDED.price, EXCLUDED.amount,
+               EXCLUDED.currency, EXCLUDED."occurredAt")
+        RETURNING (xmax = 0), "accountId", date_part('year', "occurredAt")::int
+        """,
+        """(%(id)s, %(account_id)s, %(type)s, %(symbol)s, %(description)s,
+            %(quantity)s, %(price)s, %(amount)s, %(currency)s, %(occurred_at)s)""",
+        ("id",),
+    ),
+    "dividends": (
+        """
         INSERT INTO dividends (id, "accountId", symbol, amount, currency,
                                 "paymentDate", frequency)
-        VALUES (%(id)s, %(account_id)s, %(symbol)s, %(amount)s, %(currency)s,
-                %(payment_date)s, %(frequency)s)
+        VALUES %s
         ON CONFLICT ("accountId", symbol, "paymentDate") DO UPDATE SET
             amount = EXCLUDED.amount,
             currency = EXCLUDED.currency,
-            frequency = EXCLUDED.frequency
-    """, dividend)
-
-
-def upsert_security(cur, security: dict):
-    """Upsert a security."""
-    cur.execute("""
+            frequency = COALESCE(EXCLUDED.frequency, dividends.frequency)
+        WHERE (dividends.amount, dividends.currency, dividends.frequency)
+          IS DISTINCT FROM
+              (EXCLUDED.amount, EXCLUDED.currency, COALESCE(EXCLUDED.frequency, dividends.frequency))
+        RETURNING (xmax = 0), "accountId", symbol, "paymentDate"
+        """,
+        """(%(id)s, %(account_id)s, %(symbol)s, %(amount)s, %(currency)s,
+            %(payment_date)s, %(frequency)s)""",
+        ("account_id", "symbol", "payment_date"),
+    ),
+    "securities": (
+        """
         INSERT INTO securities (id, symbol, name, type, exchange, currency,
-                                "dividendYield", mer, "peRatio", "marketCap", "updatedAt")
-        VALUES (%(id)s, %(symbol)s, %(name)s, %(type)s, %(exchange)s, %(currency)s,
-                %(dividend_yield)s, %(mer)s, %(pe_ratio)s, %(market_cap)s, NOW())
+                                "dividendYield", mer, "peRatio", "marketCap", sector,
+                                "updatedAt")
+        VALUES %s
         ON CONFLICT (id) DO UPDATE SET
             symbol = EXCLUDED.symbol,
             name = EXCLUDED.name,
-            type = EXCLUDED.type,
-            exchange = EXCLUDED.exchange,
+            type = COALESCE(EXCLUDED.type, securities.type),
+            exchange = COALESCE(EXCLUDED.exchange, securities.exchange),
             currency = EXCLUDED.currency,
-            "dividendYield" = EXCLUDED."dividendYield",
-            mer = EXCLUDED.mer,
-            "peRatio" = EXCLUDED."peRatio",
-            "marketCap" = EXCLUDED."marketCap",
+            "dividendYield" = COALESCE(EXCLUDED."dividendYield", securities."dividendYield"),
+            mer = COALESCE(EXCLUDED.mer, securities.mer),
+            "peRatio" = COALESCE(EXCLUDED."peRatio", securities."peRatio"),
+            "marketCap" = COALESCE(EXCLUDED."marketCap", securities."marketCap"),
+            sector = COALESCE(EXCLUDED.sector, securities.sector),
+            "updatedAt" = NOW()
+        RETURNING (xmax = 0)
+        """,
+        """(%(id)s, %(symbol)s, %(name)s, %(type)s, %(exchange)s, %(currency)s,
+            %(dividend_yield)s, %(mer)s, %(pe_ratio)s, %(market_cap)s, %(sector)s, NOW())""",
+        ("id",),
+    ),
+    "portfolio_daily": (
+        """
+        INSERT INTO portfolio_daily (date, netliquidation, deposits, withdrawals, earnings,
+                                     "netFlow", "dailyReturn", "twrIndex", "mwrReturn",
+                                     "flowWeight", "updatedAt")
+        VALUES %s
+        ON CONFLICT (date) DO UPDATE SET
+            netliquidation = EXCLUDED.netliquidation,
+            deposits = EXCLUDED.deposits,
+            withdrawals = EXCLUDED.withdrawals,
+            earnings = EXCLUDED.earnings,
+            "netFlow" = EXCLUDED."netFlow",
+            "dailyReturn" = EXCLUDED."dailyReturn",
+            "twrIndex" = EXCLUDED."twrIndex",
+            "mwrReturn" = EXCLUDED."mwrReturn",
+            "flowWeight" = EXCLUDED."flowWeight",
+            "updatedAt" = NOW()
+        WHERE (portfolio_daily.netliquidation, portfolio_daily.deposits,
+               portfolio_daily.withdrawals, portfolio_daily.earnings,
+               portfolio_daily."netFlow", portfolio_daily."dailyReturn",
+               portfolio_daily."twrIndex", portfolio_daily."mwrReturn",
+               portfolio_daily."flowWeight")
+          IS DISTINCT FROM
+              (EXCLUDED.netliquidation, EXCLUDED.deposits,
+               EXCLUDED.withdrawals, EXCLUDED.earnings,
+               EXCLUDED."netFlow", EXCLUDED."dailyReturn",
+               EXCLUDED."twrIndex", EXCLUDED."mwrReturn",
+               EXCLUDED."flowWeight")
+        RETURNING (xmax = 0)
+        """,
+        """(%(date)s, %(netliquidation)s, %(deposits)s, %(withdrawals)s, %(earnings)s,
+            %(net_flow)s, %(daily_return)s, %(twr_index)s, %(mwr_return)s,
+            %(flow_weight)s, NOW())""",
+        ("date",),
+    ),
+    "backfill_windows": (
+        """
+        INSERT INTO backfill_windows ("accountId", kind, "startDate", "endDate", rows, "completedAt")
+        VALUES %s
+        ON CONFLICT ("accountId", kind, "startDate", "endDate") DO UPDATE SET
+            rows = EXCLUDED.rows,
+            "completedAt" = NOW()
+        RETURNING (xmax = 0)
+        """,
+        """(%(account_id)s, %(kind)s, %(start_date)s, %(end_date)s, %(rows)s, NOW())""",
+        ("account_id", "kind", "start_date", "end_date"),
+    ),
+    "sync_checkpoints": (
+        """
+        INSERT INTO sync_checkpoints ("syncId", stage, "accountId", status, rows, error,
+                                      attempts, "updatedAt")
+        VALUES %s
+        ON CONFLICT ("syncId", stage, "accountId") DO UPDATE SET
+            status = EXCLUDED.status,
+            rows = EXCLUDED.rows,
+            error = EXCLUDED.error,
+            attempts = sync_checkpoints.attempts + 1,
             "updatedAt" = NOW()
-    """, security)
+        RETURNING (xmax = 0)
+        """,
+        """(%(sync_id)s, %(stage)s, %(account_id)s, %(status)s, %(rows)s, %(error)s, 1, NOW())""",
+        ("sync_id", "stage", "account_id"),
+    ),
+    "quote_cache": (
+        """
+        INSERT INTO quote_cache (symbol, data, "fetchedAt")
+        VALUES %s
+        ON CONFLICT (symbol) DO UPDATE SET
+            data = EXCLUDED.data,
+            "fetchedAt" = EXCLUDED."fetchedAt"
+        RETURNING (xmax = 0)
+        """,
+        """(%(symbol)s, %(data)s, NOW())""",
+        ("symbol",),
+    ),
+}
+
+DEFAULT_BATCH_SIZE = 500
+ACTIVITY_PAGE_SIZE = 100
+
+# Whole-set replacements: table -> (statement over a staged VALUES list,
+# statement for an empty set, scope field). The statement stages one scope's
+# complete rows, upserts them with the table's UPSERTS statement and deletes
+# every row of that scope that is no longer staged, all in one round trip.
+REPLACES = {
+    "positions": (
+        """
+        WITH staged (id, "accountId", "securityId", symbol, name, quantity,
+                     "bookValue", "marketValue", "gainLoss", "gainLossPct",
+                     currency, "updatedAt") AS (VALUES %s),
+        written AS ({upsert}),
+        removed AS (
+            DELETE FROM positions p
+            WHERE p."accountId" IN (SELECT "accountId" FROM staged)
+              AND NOT EXISTS (SELECT 1 FROM staged s
+                              WHERE s."accountId" = p."accountId" AND s.symbol = p.symbol)
+            RETURNING 1
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted),
+               (SELECT count(*) FROM removed)
+        FROM written
+        """.replace("{upsert}", UPSERTS["positions"][0].replace("VALUES %s", "SELECT * FROM staged")
+                                                      .replace("RETURNING (xmax = 0)", "RETURNING (xmax = 0) AS inserted")),
+        """DELETE FROM positions WHERE "accountId" = %s""",
+        "account_id",
+    ),
+}
+
+
+class BulkWriter:
+    """Buffer normalized rows per table and flush them as multi-row upserts."""
+
+    def __init__(self, cur, batch_size: int = DEFAULT_BATCH_SIZE, metrics: SyncMetrics | None = None,
+                 touched: dict[str, set] | None = None):
+        self.cur = cur
+        self.batch_size = max(1, batch_size)
+        self.metrics = metrics
+        self.buffers: dict[str, dict] = {}
+        # Pass one dict to several writers to collect a whole run's changes.
+        self.touched: dict[str, set] = {} if touched is None else touched
+
+    def add(self, table: str, row: dict):
+        """Queue a row, flushing the table once a full batch is buffered."""
+        if self._buffer(table, row) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table: str | None = None):
+        """Write buffered rows for one table, or for every table in queue order."""
+        for name, rows in self._take(table):
+            sql, template, _ = UPSERTS[name]
+            started = time.perf_counter()
+            written = psycopg2.extras.execute_values(
+                self.cur, sql, rows, template=template,
+                page_size=self.batch_size, fetch=True,
+            )
+            self._record(name, len(rows), written, time.perf_counter() - started)
+
+    def replace(self, table: str, scope, rows: list[dict]):
+        """Make ``rows`` the complete set of ``table`` rows for ``scope`` in one statement."""
+        # Flush everything, not just ``table``: rows it references (securities
+        # for positions) may still be buffered.
+        self.flush()
+        sql, clear_sql, _ = REPLACES[table]
+        rows = self._dedupe(table, rows)
+        started = time.perf_counter()
+        if rows:
+            (inserted, updated, deleted), = psycopg2.extras.execute_values(
+                self.cur, sql, rows, template=UPSERTS[table][1], page_size=len(rows), fetch=True,
+            )
+        else:
+            self.cur.execute(clear_sql, (scope,))
+            inserted, updated, deleted = 0, 0, self.cur.rowcount
+        if self.metrics:
+            self.metrics.record_write(table, len(rows), time.perf_counter() - started,
+                                      inserted=inserted, updated=updated, deleted=deleted)
+
+    def _dedupe(self, table: str, rows: list[dict]) -> list[dict]:
+        key_fields = UPSERTS[table][2]
+        return list({tuple(row[f] for f in key_fields): row for row in rows}.values())
+
+    def _buffer(self, table: str, row: dict) -> int:
+        key_fields = UPSERTS[table][2]
+        buffer = self.buffers.setdefault(table, {})
+        # A single INSERT ... ON CONFLICT DO UPDATE cannot touch the same key
+        # twice, so keep the last row per key like sequential upserts did.
+        buffer[tuple(row[f] for f in key_fields)] = row
+        return len(buffer)
+
+    def _take(self, table: str | None):
+        for name in [table] if table else list(self.buffers):
+            rows = self.buffers.pop(name, None)
+            if rows:
+                yield name, list(rows.values())
+
+    def _record(self, name: str, sent: int, written: list, seconds: float):
+        if written and len(written[0]) > 1:
+            self.touched.setdefault(name, set()).update(tuple(r[1:]) for r in written)
+        if self.metrics:
+            inserted = sum(1 for r in written if r[0])
+            self.metrics.record_write(name, sent, seconds, inserted=inserted, updated=len(written) - inserted)
+
+
+class PipelineWriter:
+    """Feed a BulkWriter from a bounded queue on a background thread.
+
+    Stages call add() exactly as they would on a BulkWriter and only block
+    while the queue is full, so fetching and normalizing the next records
+    overlaps with writing the previous batch. flush() waits until every
+    queued row has been written. A write error is raised from the next
+    add() or flush().
+    """
+
+    def __init__(self, writer: BulkWriter, max_queued: int):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max(1, max_queued))
+        self.error = None
+        self.thread = threading.Thread(target=self._drain, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        while True:
+            method, item = self.queue.get()
+            if method is None:
+                if item is None:
+                    return
+                # Flush request: item is the Event the caller waits on.
+                if self.error is None:
+                    try:
+                        self.writer.flush()
+                    except Exception as e:
+                        self.error = e
+                item.set()
+            elif self.error is None:
+                # After an error keep draining, so producers never block on a full queue.
+                try:
+                    getattr(self.writer, method)(*item)
+                except Exception as e:
+                    self.error = e
+
+    def add(self, table: str, row: dict):
+        self._put("add", (table, row))
+
+    def replace(self, table: str, scope, rows: list[dict]):
+        self._put("replace", (table, scope, rows))
+
+    def _put(self, method: str, item: tuple):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((method, item))
+
+    def flush(self):
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.queue.put((None, None))
+        self.thread.join()
+
+
+def upsert_account(writer: BulkWriter, account: dict):
+    """Queue a single WS account for upsert."""
+    writer.add("accounts", account)
+
+
+def replace_positions(writer: BulkWriter, account_id: str, positions: list[dict]):
+    """Queue an account's complete positions, replacing whatever it held before."""
+    writer.replace("positions", account_id, positions)
+
+
+def upsert_snapshot(writer: BulkWriter, snapshot: dict):
+    """Queue an account snapshot for upsert."""
+    writer.add("account_snapshots", snapshot)
+
+
+def upsert_activity(writer: BulkWriter, activity: dict):
+    """Queue an activity for upsert."""
+    writer.add("activities", activity)
+
+
+def upsert_checkpoint(writer: BulkWriter, checkpoint: dict):
+    """Queue a stage/account checkpoint for upsert."""
+    writer.add("sync_checkpoints", checkpoint)
+
 
+def upsert_security(writer: BulkWriter, security: dict):
+    """Queue a security for upsert."""
+    writer.add("securities", security)
 
-def create_sync_log(cur, status="running"):
+
+def create_sync_log(cur, status="running", profile: str | None = None):
     """Create a new sync log entry, return its ID."""
-    import uuid
-    sync_id = str(uuid.uuid4())[:25]  # cuid-like
+    sync_id = new_row_id()
     cur.execute("""
-        INSERT INTO sync_logs (id, "startedAt", status)
-        VALUES (%s, NOW(), %s)
-    """, (sync_id, status))
+        INSERT INTO sync_logs (id, "startedAt", status, profile)
+        VALUES (%s, NOW(), %s, %s)
+    """, (sync_id, status, profile))
     return sync_id
 
 
+# A sync is resumable once it has checkpoints (so it is one of ours, not a
+# log row written by the dashboard) and it failed: it ended in error, it
+# succeeded with failed checkpoints, or it is still marked running but has
+# not checkpointed for RESUME_STALE_MINUTES, so its process is gone rather
+# than still working. ``{match}`` picks the candidates.
+RESUMABLE_SYNC_SQL = """
+    SELECT id FROM sync_logs s
+    WHERE {match}
+      AND EXISTS (SELECT 1 FROM sync_checkpoints c WHERE c."syncId" = s.id)
+      AND (s.status = 'error'
+           OR (s.status = 'success'
+               AND EXISTS (SELECT 1 FROM sync_checkpoints c
+                           WHERE c."syncId" = s.id AND c.status = 'failed'))
+           OR (s.status = 'running'
+               AND (SELECT MAX(c."updatedAt") FROM sync_checkpoints c WHERE c."syncId" = s.id)
+                   < NOW() - %(stale_minutes)s * interval '1 minute'))
+    ORDER BY "startedAt" DESC
+    LIMIT 1
+"""
+
+RESUME_STALE_MINUTES = 60
+# A bare --resume only picks up syncs started this recently.
+RESUME_MAX_AGE_HOURS = 48
+
+
+def find_resumable_sync(cur, sync_id: str | None = None, profile: str | None = None) -> str | None:
+    """Return ``sync_id``, or the profile's latest recent sync, if it is resumable."""
+    if sync_id:
+        match = "s.id = %(sync_id)s"
+    else:
+        match = """s.profile IS NOT DISTINCT FROM %(profile)s
+                   AND s."startedAt" >= NOW() - %(max_age_hours)s * interval '1 hour'"""
+    cur.execute(RESUMABLE_SYNC_SQL.replace("{match}", match), {
+        "sync_id": sync_id, "profile": profile,
+        "stale_minutes": RESUME_STALE_MINUTES, "max_age_hours": RESUME_MAX_AGE_HOURS,
+    })
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def get_completed_checkpoints(cur, sync_id: str) -> set[tuple[str, str]]:
+    """Return the (stage, accountId) pairs that finished in ``sync_id``."""
+    cur.execute("""
+        SELECT stage, "accountId" FROM sync_checkpoints
+        WHERE "syncId" = %s AND status = 'success'
+    """, (sync_id,))
+    return set(cur.fetchall())
+
+
+RESUMED_COUNT_COLUMNS = {
+    "positions_count": '"positionsCount"',
+    "snapshots_count": '"snapshotsCount"',
+    "activities_count": '"activitiesCount"',
+    "dividends_count": '"dividendsCount"',
+    "inserted_count": '"insertedCount"',
+    "updated_count": '"updatedCount"',
+    "unchanged_count": '"unchangedCount"',
+}
+
+
+def add_resumed_counts(cur, sync_id: str, counts: dict) -> dict:
+    """Add the counts ``sync_id`` already logged, so a resumed sync records its whole run."""
+    cur.execute(
+        f"SELECT {', '.join(RESUMED_COUNT_COLUMNS.values())} FROM sync_logs WHERE id = %s",
+        (sync_id,),
+    )
+    previous = dict(zip(RESUMED_COUNT_COLUMNS, cur.fetchone()))
+    return {key: n + previous.get(key, 0) for key, n in counts.items()}
+
+
+class Checkpoints:
+    """Per-account progress of one sync run, kept in sync_checkpoints.
+
+    done() and failed() return a ``sync_checkpoints`` row for the stage's
+    own writer, so a checkpoint commits together with the rows it vouches
+    for. On resume, accounts already completed for a stage are skipped by
+    pending().
+    """
+
+    def __init__(self, sync_id: str, completed: set[tuple[str, str]] | None = None):
+        self.sync_id = sync_id
+        self.completed = completed or set()
+
+    def pending(self, stage: str, accounts: list[dict]) -> list[dict]:
+        return [acc for acc in accounts if (stage, acc["id"]) not in self.completed]
+
+    def done(self, stage: str, account_id: str, rows: int) -> dict:
+        return self._row(stage, account_id, "success", rows, None)
+
+    def failed(self, stage: str, account_id: str, error: Exception) -> dict:
+        return self._row(stage, account_id, "failed", 0, str(error)[:500])
+
+    def _row(self, stage, account_id, status, rows, error) -> dict:
+        return {
+            "sync_id": self.sync_id, "stage": stage, "account_id": account_id,
+            "status": status, "rows": rows, "error": error,
+        }
+
+
+DEFAULT_OVERLAP_DAYS = 7
+
+ACTIVITY_CUTOFFS_SQL = """
+    SELECT "accountId", (MAX("occurredAt") - make_interval(days => %s))::date
+    FROM activities
+    GROUP BY "accountId"
+"""
+
+SNAPSHOT_CUTOFFS_SQL = """
+    SELECT "accountId", MAX(date)
+    FROM account_snapshots
+    GROUP BY "accountId"
+"""
+
+
+def get_activity_cutoffs(cur, overlap_days: int) -> dict[str, str]:
+    """Return, per account, the latest stored activity date minus the overlap window."""
+    cur.execute(ACTIVITY_CUTOFFS_SQL, (overlap_days,))
+    return {account_id: cutoff.isoformat() for account_id, cutoff in cur.fetchall()}
+
+
+def get_snapshot_cutoffs(cur) -> dict[str, str]:
+    """Return the latest stored snapshot date per account."""
+    cur.execute(SNAPSHOT_CUTOFFS_SQL)
+    return {account_id: last_date.isoformat() for account_id, last_date in cur.fetchall()}
+
+
+KNOWN_SECURITIES_SQL = """
+    SELECT id, symbol, "updatedAt" >= NOW() - %s * interval '1 hour'
+    FROM securities
+"""
+
+
+def get_known_securities(cur, ttl_hours: float) -> dict[str, tuple[str, bool]]:
+    """Return ``{security_id: (symbol, refreshed within the TTL)}`` for stored securities."""
+    cur.execute(KNOWN_SECURITIES_SQL, (ttl_hours,))
+    return {security_id: (symbol, fresh) for security_id, symbol, fresh in cur.fetchall()}
+
+
 def update_sync_log(cur, sync_id, **kwargs):
     """Update sync log with counts and status."""
     sets = []
@@ -172,12 +959,16 @@ def update_sync_log(cur, sync_id, **kwargs):
             "activities_count": '"activitiesCount"',
             "snapshots_count": '"snapshotsCount"',
             "dividends_count": '"dividendsCount"',
+            "inserted_count": '"insertedCount"',
+            "updated_count": '"updatedCount"',
+            "unchanged_count": '"unchangedCount"',
             "error": "error",
             "completed_at": '"completedAt"',
+            "metrics": "metrics",
         }
         if key in col_map:
             sets.append(f"{col_map[key]} = %s")
-            params.append(value)
+            params.append(psycopg2.extras.Json(value) if isinstance(value, dict) else value)
     if sets:
         params.append(sync_id)
         cur.execute(f"UPDATE sync_logs SET {', '.join(sets)} WHERE id = %s", params)
@@ -187,14 +978,34 @@ def update_sync_log(cur, sync_id, **kwargs):
 # Wealthsimple API helpers
 # ---------------------------------------------------------------------------
 
-def ws_login(email: str, password: str, totp_code: str | None = None):
-    """Log in to Wealthsimple and return the API client."""
+KEYRING_SERVICE = "wealthsimple-sync"
+
+
+def ws_login(email: str, password: str, totp_code: str | None = None, tokens: list | None = None):
+    """Log in to Wealthsimple and return the API client.
+
+    Saved ``tokens`` are tried first; a full login is only done if they
+    are missing or rejected.
+    """
     try:
         from wsimple.api import Wsimple
     except ImportError:
         print("ERROR: wsimple package not found. Install with: pip install wsimple")
         sys.exit(1)
 
+    if tokens:
+        try:
+            ws = Wsimple.oauth_login(tokens)
+            ws.get_accounts()
+            print(f"Resumed saved session for {email}")
+            return ws
+        except Exception as e:
+            print(f"  Saved session rejected ({e}), logging in again")
+
+    if not totp_code and not sys.stdin.isatty():
+        raise RuntimeError("a TOTP code is needed and there is no terminal to prompt for one; "
+                           "rerun with a fresh --totp")
+
     print(f"Logging in as {email}...")
 
     if totp_code:
@@ -207,97 +1018,711 @@ def ws_login(email: str, password: str, totp_code: str | None = None):
     return ws
 
 
-def normalize_account_type(ws_type: str) -> str:
-    """Map WS account types to our schema."""
-    mapping = {
-        "ca_tfsa": "TFSA",
-        "ca_rrsp": "RRSP",
-        "ca_fhsa": "FHSA",
-        "ca_non_registered": "NON_REG",
-        "ca_non_registered_crypto": "CRYPTO",
-        "us_non_registered": "USD",
-        "ca_resp": "RESP",
-        "ca_lira": "LIRA",
-    }
-    return mapping.get(ws_type.lower(), ws_type.upper())
-
-
-def normalize_activity_type(ws_type: str) -> str:
-    """Map WS activity types to our schema."""
-    mapping = {
-        "diy_buy": "buy",
-        "diy_sell": "sell",
-        "dividend": "dividend",
-        "deposit": "deposit",
-        "withdrawal": "withdrawal",
-        "institutional_transfer": "transfer",
-        "fee": "fee",
-        "interest": "interest",
-        "contribution": "contribution",
-        "refund": "refund",
-        "payment_transfer_in": "deposit",
-        "payment_transfer_out": "withdrawal",
-        "referral_bonus": "deposit",
-        "giveaway_bonus": "deposit",
-    }
-    ws_lower = ws_type.lower()
-    return mapping.get(ws_lower, ws_lower)
+def load_session_tokens(email: str) -> list | None:
+    """Return the session tokens saved in the OS keyring for ``email``, if any."""
+    try:
+        import keyring
+        saved = keyring.get_password(KEYRING_SERVICE, email)
+    except Exception as e:
+        print(f"  Warning: Could not read keyring: {e}")
+        return None
+    return json.loads(saved) if saved else None
+
+
+def save_session_tokens(ws, email: str):
+    """Save the client's current access/refresh tokens to the OS keyring."""
+    box = getattr(ws, "box", None)
+    tokens = box.tokens if box is not None else getattr(ws, "tokens", None)
+    if not tokens:
+        return
+    try:
+        import keyring
+        keyring.set_password(KEYRING_SERVICE, email, json.dumps(tokens))
+    except Exception as e:
+        print(f"  Warning: Could not save session to keyring: {e}")
+
+
+class PrefetchingClient:
+    """Wrap a WS client so API calls can be issued ahead of the sync stages.
+
+    Calls queued with prefetch() run on a bounded thread pool. When a stage
+    later makes the same get_* call it receives that call's result, or its
+    exception, so per-account error handling is unchanged. Calls that were
+    never prefetched go straight to the wrapped client.
+    """
+
+    def __init__(self, ws, max_workers: int):
+        self.ws = ws
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ws-fetch")
+        self.pending = {}
+
+    def prefetch(self, method: str, *args, **kwargs):
+        key = (method, args, tuple(sorted(kwargs.items())))
+        if key not in self.pending:
+            self.pending[key] = self.pool.submit(getattr(self.ws, method), *args, **kwargs)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def __getattr__(self, name):
+        attr = getattr(self.ws, name)
+        if not name.startswith("get_"):
+            return attr
+
+        def call(*args, **kwargs):
+            future = self.pending.pop((name, args, tuple(sorted(kwargs.items()))), None)
+            if future is None:
+                return attr(*args, **kwargs)
+            return future.result()
+
+        return call
+
+
+def prefetch_account_data(ws: PrefetchingClient, accounts: list[dict],
+                          snapshot_since: dict[str, str] | None = None,
+                          checkpoints: Checkpoints | None = None,
+                          page_size: int = ACTIVITY_PAGE_SIZE):
+    """Queue every per-account call made by the positions, history and activity stages.
+
+    Calls are queued stage by stage so the earliest stage's data lands first
+    and its writes overlap with the remaining fetches. Only the first page
+    of activities is prefetched; later pages are requested as the stage
+    consumes them. Accounts a resumed run already completed for a stage
+    are left out.
+    """
+    pending = checkpoints.pending if checkpoints else (lambda stage, accs: accs)
+    for acc in pending("positions", accounts):
+        ws.prefetch("get_positions", acc["id"])
+    for acc in pending("historical", accounts):
+        ws.prefetch(
+            "get_historical_financials", acc["id"],
+            history_window((snapshot_since or {}).get(acc["id"])),
+        )
+    for acc in pending("activities", accounts):
+        ws.prefetch("get_activities", acc["id"], limit=page_size)
+
+
+# ---------------------------------------------------------------------------
+# Record / replay
+# ---------------------------------------------------------------------------
+
+RECORDED_METHODS = ("get_accounts", "get_positions", "get_historical_financials", "get_activities",
+                    "get_security")
+
+
+class RecordingClient:
+    """Wrap a WS client and append every raw API response to a gzipped NDJSON cassette."""
+
+    def __init__(self, ws, path: str):
+        self.ws = ws
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.file.close()
+
+    def __getattr__(self, name):
+        attr = getattr(self.ws, name)
+        if name not in RECORDED_METHODS:
+            return attr
+
+        def call(*args, **kwargs):
+            entry = {"method": name, "args": list(args), "kwargs": kwargs}
+            try:
+                entry["response"] = result = attr(*args, **kwargs)
+                return result
+            except Exception as e:
+                entry["error"] = str(e)
+                raise
+            finally:
+                line = json.dumps(entry, default=str)
+                with self.lock:
+                    self.file.write(line + "\n")
+
+        return call
+
+
+class ReplayClient:
+    """Serve get_* calls from a cassette written by RecordingClient.
+
+    Calls are matched on method and arguments. If there is no exact match,
+    the last recording for the same method and account is used, so a
+    different history window still replays. Recorded errors are raised
+    again. ``latency`` seconds are slept before every call to stand in for
+    the network.
+    """
+
+    def __init__(self, path: str, latency: float = 0.0):
+        self.latency = latency
+        self.exact = {}
+        self.by_account = {}
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                args = tuple(entry["args"])
+                key = (entry["method"], args, tuple(sorted(entry["kwargs"].items())))
+                self.exact[key] = entry
+                self.by_account[(entry["method"], args[:1])] = entry
+
+    def _replay(self, method: str, args: tuple, kwargs: dict):
+        if self.latency:
+            time.sleep(self.latency)
+        entry = (
+            self.exact.get((method, args, tuple(sorted(kwargs.items()))))
+            or self.by_account.get((method, args[:1]))
+        )
+        if entry is None:
+            raise LookupError(f"No recorded response for {method}{args}")
+        if "error" in entry:
+            raise RuntimeError(entry["error"])
+        return entry["response"]
+
+    def get_accounts(self):
+        return self._replay("get_accounts", (), {})
+
+    def get_positions(self, account_id, **kwargs):
+        return self._replay("get_positions", (account_id,), kwargs)
+
+    def get_historical_financials(self, account_id, window, **kwargs):
+        return self._replay("get_historical_financials", (account_id, window), kwargs)
+
+    def get_activities(self, account_id, **kwargs):
+        return self._replay("get_activities", (account_id,), kwargs)
+
+    def get_security(self, security_id, **kwargs):
+        return self._replay("get_security", (security_id,), kwargs)
+
+
+# ---------------------------------------------------------------------------
+# Normalization
+# ---------------------------------------------------------------------------
+
+ACCOUNT_TYPES = {
+    "ca_tfsa": "TFSA",
+    "ca_rrsp": "RRSP",
+    "ca_fhsa": "FHSA",
+    "ca_non_registered": "NON_REG",
+    "ca_non_registered_crypto": "CRYPTO",
+    "us_non_registered": "USD",
+    "ca_resp": "RESP",
+    "ca_lira": "LIRA",
+}
+
+ACTIVITY_TYPES = {
+    "diy_buy": "buy",
+    "diy_sell": "sell",
+    "dividend": "dividend",
+    "deposit": "deposit",
+    "withdrawal": "withdrawal",
+    "institutional_transfer": "transfer",
+    "fee": "fee",
+    "interest": "interest",
+    "contribution": "contribution",
+    "refund": "refund",
+    "payment_transfer_in": "deposit",
+    "payment_transfer_out": "withdrawal",
+    "referral_bonus": "deposit",
+    "giveaway_bonus": "deposit",
+}
+
+ZERO = Decimal(0)
 
 
 def safe_decimal(value, default=0) -> Decimal:
-    """Convert to Decimal safely."""
-    if value is None:
-        return Decimal(str(default))
+    """Convert to Decimal safely.
+
+    Strings and ints, which is what the API sends, go straight to Decimal;
+    only other types take the str() round trip.
+    """
+    kind = type(value)
+    if kind is Decimal:
+        return value
     try:
-        return Decimal(str(value))
+        if kind is str or kind is int:
+            return Decimal(value)
+        if value is not None:
+            return Decimal(str(value))
     except Exception:
-        return Decimal(str(default))
+        pass
+    return ZERO if default == 0 else Decimal(str(default))
+
+
+def decode_money(value) -> Decimal:
+    """Decode a WS money object (``{"amount": ...}``) or a bare number."""
+    if type(value) is dict:
+        value = value.get("amount")
+    return safe_decimal(value)
+
+
+def optional_money(value) -> Decimal | None:
+    """Like decode_money, but keep a missing value as None."""
+    return decode_money(value) if value else None
+
+
+def optional_number(value) -> Decimal | None:
+    """Like safe_decimal, but keep a missing value as None."""
+    return safe_decimal(value) if value else None
+
+
+def map_code(table: dict, value: str, fallback) -> str:
+    """Map a WS type code through ``table``, or ``fallback(value)`` if unmapped."""
+    return table.get(value) or table.get(value.lower()) or fallback(value)
+
+
+def new_row_id() -> str:
+    """Return a random 25-character row ID, cuid-like."""
+    # os.urandom directly: several times cheaper than formatting a uuid4.
+    return os.urandom(13).hex()[:25]
+
+
+# Field extractors for compile_spec(). Each returns an emitter that renders
+# the field as a Python expression over ``raw``, registering any object it
+# needs with ``bind``. A tuple key is a path into a nested object.
+
+def _read(key) -> str:
+    if isinstance(key, str):
+        return f"raw.get({key!r})"
+    outer, inner = key
+    return f"(raw.get({outer!r}) or EMPTY).get({inner!r})"
+
+
+def text(*keys, default=None):
+    """The first truthy value among ``keys``, else ``default``."""
+    return lambda bind: "(" + " or ".join([_read(key) for key in keys] + [bind(default)]) + ")"
+
+
+def money(*keys, optional: bool = False):
+    """A money value as Decimal. Missing reads as 0, or None if ``optional``."""
+    decode = optional_money if optional else decode_money
+    return lambda bind: f"{bind(decode)}({text(*keys)(bind)})"
+
+
+def number(*keys, optional: bool = False):
+    """A plain number as Decimal; unlike money(), an object is not unwrapped and reads as 0."""
+    decode = optional_number if optional else safe_decimal
+    return lambda bind: f"{bind(decode)}({text(*keys)(bind)})"
+
+
+def code(table: dict, *keys, default: str, fallback):
+    """A type code mapped through ``table``; see map_code()."""
+    pick = text(*keys, default=default)
+    return lambda bind: f"{bind(map_code)}({bind(table)}, {pick(bind)}, {bind(fallback)})"
+
+
+def call(function):
+    """Whatever ``function(raw)`` returns."""
+    return lambda bind: f"{bind(function)}(raw)"
+
+
+def compile_spec(spec: dict):
+    """Compile a field -> extractor spec into one function returning a tuple of values.
+
+    The fields become inline expressions of a single generated function, so
+    a record costs one call rather than one per field.
+    """
+    namespace = {"EMPTY": {}}
+
+    def bind(value) -> str:
+        name = f"_{len(namespace)}"
+        namespace[name] = value
+        return name
+
+    fields = ", ".join(emit(bind) for emit in spec.values())
+    exec(f"def extract(raw):\n    return ({fields},)", namespace)
+    return namespace["extract"]
+
+
+class Row(Mapping):
+    """A normalized table row: attribute slots that read like a dict.
+
+    Writers and their ``%(name)s`` templates index rows by field name, so a
+    row works anywhere a dict did, at a fraction of the memory. Subclasses
+    list their fields in ``__slots__`` and are built positionally.
+    """
+
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Generate a plain positional __init__, as namedtuple and dataclasses
+        # do; it is several times faster than setattr() in a loop.
+        namespace = {}
+        body = "".join(f"\n    self.{name} = {name}" for name in cls.__slots__)
+        exec(f"def __init__(self, {', '.join(cls.__slots__)}):{body}", namespace)
+        cls.__init__ = namespace["__init__"]
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class AccountRow(Row):
+    __slots__ = ("id", "type", "nickname", "currency", "status", "netliquidation",
+                 "buying_power", "total_deposits", "total_withdrawals", "created_at")
+
+
+class PositionRow(Row):
+    __slots__ = ("id", "account_id", "security_id", "symbol", "name", "quantity", "book_value",
+                 "market_value", "gain_loss", "gain_loss_pct", "currency")
+
+
+class SnapshotRow(Row):
+    __slots__ = ("id", "account_id", "date", "netliquidation", "deposits", "withdrawals", "earnings")
+
+
+class ActivityRow(Row):
+    __slots__ = ("id", "account_id", "type", "symbol", "description", "quantity", "price",
+                 "amount", "currency", "occurred_at", "security_id")
 
 
 # ---------------------------------------------------------------------------
 # Sync logic
 # ---------------------------------------------------------------------------
 
-def sync_accounts(ws, cur) -> list[dict]:
-    """Fetch and upsert all WS accounts. Return list of account dicts."""
-    print("\nFetching accounts...")
-    raw_accounts = ws.get_accounts()
+# Each stage is a chain of generators: a fetcher yields raw API records, a
+# normalizer turns them into Row objects, and the stage loop hands the rows to
+# the writer. Nothing holds more than one API response at a time.
+
+def iter_results(raw):
+    """Yield the records of a WS list response, bare or wrapped in ``results``."""
+    if isinstance(raw, list):
+        yield from raw
+    elif raw:
+        yield from raw.get("results", [])
+
+
+def fetch_accounts(ws):
+    yield from iter_results(ws.get_accounts())
+
+
+def fetch_positions(ws, acc: dict):
+    yield from iter_results(ws.get_positions(acc["id"]))
+
+
+def fetch_history(ws, acc: dict, window: str):
+    yield from iter_results(ws.get_historical_financials(acc["id"], window))
+
+
+def fetch_activity_pages(ws, acc: dict, page_size: int = ACTIVITY_PAGE_SIZE,
+                         cutoff: str | None = None, **filters):
+    """Yield an account's activities one API page at a time, following the bookmark.
+
+    The feed runs newest first, so paging stops after the first page that
+    lies wholly before a YYYY-MM-DD ``cutoff``.
+    """
+    bookmark, seen = None, set()
+    while True:
+        params = {"limit": page_size, **filters}
+        if bookmark:
+            params["bookmark"] = bookmark
+        raw = ws.get_activities(acc["id"], **params)
+        page = list(iter_results(raw))
+        yield page
+
+        bookmark = raw.get("bookmark") if isinstance(raw, dict) else None
+        if not page or not bookmark or bookmark in seen:
+            return
+        if cutoff and all(activity_occurred_at(act)[:10] < cutoff for act in page):
+            return
+        seen.add(bookmark)
+
+
+def fetch_history_range(ws, acc: dict, start: date, end: date):
+    yield from iter_results(ws.get_historical_financials(
+        acc["id"], "all", start_date=start.isoformat(), end_date=end.isoformat(),
+    ))
+
+
+def fetch_activities_range(ws, acc: dict, start: date, end: date,
+                           page_size: int = ACTIVITY_PAGE_SIZE):
+    # The cutoff stops paging past the window should the API ignore the range.
+    for page in fetch_activity_pages(ws, acc, page_size, cutoff=start.isoformat(),
+                                     start_date=start.isoformat(), end_date=end.isoformat()):
+        yield from page
+
+
+def fetch_security(ws, security_id: str) -> dict:
+    raw = ws.get_security(security_id)
+    results = raw.get("results") if isinstance(raw, dict) else None
+    if isinstance(results, list):
+        raw = results[0] if results else {}
+    return raw or {}
+
+
+def activity_occurred_at(act: dict) -> str:
+    """Return a raw activity's timestamp as an ISO string, or now if it has none."""
+    occurred_at = act.get("occurredAt") or act.get("processDate") or act.get("createdAt")
+    if isinstance(occurred_at, str) and len(occurred_at) >= 10:
+        return occurred_at  # keep as string, psycopg2 handles it
+    return datetime.now().isoformat()
+
+
+# Field specs per entity, compiled once. Fields that depend on the account,
+# on other fields or on a cutoff are filled in by the normalizers below.
+extract_account = compile_spec({
+    "id": text("id", "unifiedAccountId"),
+    "type": code(ACCOUNT_TYPES, "accountType", "type", default="UNKNOWN", fallback=str.upper),
+    "nickname": text("nickname", "accountName"),
+    "currency": text("currency", default="CAD"),
+    "status": text("status", default="open"),
+    "netliquidation": money("currentBalance"),
+    "buying_power": money("buyingPower"),
+    "total_deposits": money("deposits"),
+    "total_withdrawals": money("withdrawals"),
+    "created_at": text("createdAt", "created_at"),
+})
+
+extract_position = compile_spec({
+    "security_id": text(("stock", "securityId"), "securityId"),
+    "symbol": text(("stock", "symbol"), "symbol", "securitySymbol", default="UNKNOWN"),
+    "name": text(("stock", "name"), "securityName"),
+    "quantity": number("quantity"),
+    "book_value": money("bookValue"),
+    "market_value": money("marketValue"),
+    "currency": text("currency"),
+})
+
+extract_snapshot = compile_spec({
+    "date": text("date"),
+    "netliquidation": money("value"),
+    "deposits": money("deposits"),
+    "withdrawals": money("withdrawals"),
+    "earnings": money("earnings"),
+})
+
+extract_activity = compile_spec({
+    "id": text("id", "canonicalId"),
+    "type": code(ACTIVITY_TYPES, "type", "activityType", default="unknown", fallback=str.lower),
+    "symbol": text("symbol", "securitySymbol"),
+    "description": text("description", "subHeader"),
+    "quantity": number("quantity", optional=True),
+    "price": money("price", "marketPrice", optional=True),
+    "amount": text("amount", "netAmount"),
+    "occurred_at": call(activity_occurred_at),
+    "security_id": text("securityId", ("stock", "securityId")),
+})
+
+
+def normalize_accounts(raw_accounts):
+    """Map raw WS accounts to ``accounts`` rows."""
+    for acc in raw_accounts:
+        values = extract_account(acc)
+        if values[0]:  # id
+            yield AccountRow(*values)
+
+
+def normalize_positions(acc: dict, raw_positions):
+    """Map an account's raw WS positions to ``positions`` rows."""
+    account_id, account_currency = acc["id"], acc["currency"]
+    for pos in raw_positions:
+        security_id, symbol, name, quantity, book_value, market_value, currency = extract_position(pos)
+        gain_loss = market_value - book_value
+        gain_loss_pct = (gain_loss / book_value * 100) if book_value else ZERO
+        yield PositionRow(
+            new_row_id(), account_id, security_id, symbol, name or symbol, quantity,
+            book_value, market_value, gain_loss, gain_loss_pct, currency or account_currency,
+        )
 
-    accounts = []
-    for acc in raw_accounts.get("results", raw_accounts if isinstance(raw_accounts, list) else []):
-        account_id = acc.get("id", acc.get("unifiedAccountId", ""))
-        if not account_id:
+
+def normalize_snapshots(acc: dict, entries, cutoff: str | None = None):
+    """Map an account's raw history entries to ``account_snapshots`` rows on or after ``cutoff``."""
+    account_id = acc["id"]
+    for entry in entries:
+        entry_date, netliquidation, deposits, withdrawals, earnings = extract_snapshot(entry)
+        if not entry_date:
             continue
 
-        account_data = {
-            "id": account_id,
-            "type": normalize_account_type(acc.get("accountType", acc.get("type", "UNKNOWN"))),
-            "nickname": acc.get("nickname") or acc.get("accountName"),
-            "currency": acc.get("currency", "CAD"),
-            "status": acc.get("status", "open"),
-            "netliquidation": safe_decimal(
-                acc.get("currentBalance", {}).get("amount")
-                if isinstance(acc.get("currentBalance"), dict)
-                else acc.get("currentBalance", 0)
-            ),
-            "buying_power": safe_decimal(
-                acc.get("buyingPower", {}).get("amount")
-                if isinstance(acc.get("buyingPower"), dict)
-                else acc.get("buyingPower", 0)
-            ),
-            "total_deposits": safe_decimal(
-                acc.get("deposits", {}).get("amount")
-                if isinstance(acc.get("deposits"), dict)
-                else acc.get("deposits", 0)
-            ),
-            "total_withdrawals": safe_decimal(
-                acc.get("withdrawals", {}).get("amount")
-                if isinstance(acc.get("withdrawals"), dict)
-                else acc.get("withdrawals", 0)
-            ),
-        }
+        if isinstance(entry_date, str):
+            entry_date = entry_date[:10]  # YYYY-MM-DD
+
+        if cutoff and str(entry_date)[:10] < cutoff:
+            continue
 
-        upsert_account(cur, account_data)
+        yield SnapshotRow(new_row_id(), account_id, entry_date, netliquidation,
+                          deposits, withdrawals, earnings)
+
+
+def normalize_activities(acc: dict, raw_activities, cutoff: str | None = None):
+    """Map an account's raw WS activities to ``activities`` rows on or after ``cutoff``."""
+    account_id, account_currency = acc["id"], acc["currency"]
+    for act in raw_activities:
+        (act_id, act_type, symbol, description, quantity, price,
+         amount_raw, occurred_at, security_id) = extract_activity(act)
+        if not act_id or (cutoff and occurred_at[:10] < cutoff):
+            continue
+
+        if type(amount_raw) is dict:
+            amount, currency = safe_decimal(amount_raw.get("amount")), amount_raw.get("currency")
+        else:
+            amount, currency = safe_decimal(amount_raw), None
+
+        yield ActivityRow(
+            act_id, account_id, act_type, symbol, description, quantity, price,
+            amount, currency or account_currency, occurred_at, security_id,
+        )
+
+
+SECURITY_TYPES = {
+    "exchange_traded_fund": "etf",
+    "etf": "etf",
+    "equity": "stock",
+    "stock": "stock",
+    "mutual_fund": "mutual_fund",
+}
+
+
+def optional_decimal(value) -> Decimal | None:
+    """Like safe_decimal, but keep a missing or unparseable value as None."""
+    if isinstance(value, dict):
+        value = value.get("amount")
+    if value in (None, ""):
+        return None
+    try:
+        return Decimal(str(value))
+    except Exception:
+        return None
+
+
+def normalize_security(security_id: str, raw: dict) -> dict:
+    """Map raw WS security metadata to a ``securities`` row."""
+    stock = raw.get("stock", {}) or {}
+    fundamentals = raw.get("fundamentals", {}) or {}
+    symbol = stock.get("symbol") or raw.get("symbol")
+    if not symbol:
+        raise ValueError("no symbol in security metadata")
+    security_type = raw.get("security_type") or raw.get("securityType") or raw.get("type")
+
+    return {
+        "id": security_id,
+        "symbol": symbol,
+        "name": stock.get("name") or raw.get("name") or symbol,
+        "type": SECURITY_TYPES.get(str(security_type).lower()) if security_type else None,
+        "exchange": (
+            stock.get("primary_exchange")
+            or stock.get("primaryExchange")
+            or raw.get("exchange")
+        ),
+        "currency": raw.get("currency") or stock.get("currency") or "CAD",
+        "dividend_yield": optional_decimal(
+            fundamentals.get("yield") or fundamentals.get("dividendYield") or raw.get("dividendYield")
+        ),
+        "mer": optional_decimal(
+            fundamentals.get("mer") or fundamentals.get("managementExpenseRatio") or raw.get("mer")
+        ),
+        "pe_ratio": optional_decimal(
+            fundamentals.get("pe_ratio") or fundamentals.get("peRatio") or raw.get("peRatio")
+        ),
+        "market_cap": optional_decimal(
+            fundamentals.get("market_cap") or fundamentals.get("marketCap") or raw.get("marketCap")
+        ),
+        "sector": fundamentals.get("sector") or raw.get("sector"),
+    }
+
+
+class SecurityEnricher:
+    """Fetch security metadata at most once per security per run.
+
+    Securities refreshed within the TTL are never looked up, and an ID
+    requested again (the same ETF in several accounts) is skipped. resolve()
+    drops IDs with no ``securities`` row, so a failed lookup cannot break
+    the positions foreign key.
+    """
+
+    def __init__(self, ws, known: dict[str, tuple[str, bool]], max_workers: int = 1):
+        self.ws = ws
+        self.max_workers = max(1, max_workers)
+        self.lock = threading.Lock()
+        self.stored = set(known)
+        self.done = {security_id for security_id, (_, fresh) in known.items() if fresh}
+        self.owners = {symbol: security_id for security_id, (symbol, _) in known.items()}
+        self.looked_up = 0
+        self.skipped = 0
+
+    def lookup(self, security_ids) -> list[dict]:
+        """Fetch every ID not yet looked up or still fresh. Return rows to upsert."""
+        with self.lock:
+            requested = {security_id for security_id in security_ids if security_id}
+            todo = sorted(requested - self.done)
+            self.skipped += len(requested) - len(todo)
+            self.done.update(todo)
+        if not todo:
+            return []
+
+        def fetch(security_id):
+            try:
+                return security_id, normalize_security(security_id, fetch_security(self.ws, security_id))
+            except Exception as e:
+                return security_id, e
+
+        if self.max_workers > 1 and len(todo) > 1:
+            with ThreadPoolExecutor(self.max_workers, thread_name_prefix="ws-security") as pool:
+                results = list(pool.map(fetch, todo))
+        else:
+            results = [fetch(security_id) for security_id in todo]
+
+        rows = []
+        with self.lock:
+            for security_id, row in results:
+                self.looked_up += 1
+                if isinstance(row, Exception):
+                    print(f"  Warning: Could not fetch security {security_id}: {row}")
+                    continue
+                # securities.symbol is unique; never let a second ID claim a symbol.
+                owner = self.owners.setdefault(row["symbol"], security_id)
+                if owner != security_id:
+                    print(f"  Warning: Skipping security {security_id}: {row['symbol']} belongs to {owner}")
+                    continue
+                self.stored.add(security_id)
+                rows.append(row)
+        return rows
+
+    def resolve(self, security_id: str | None) -> str | None:
+        with self.lock:
+            return security_id if security_id in self.stored else None
+
+
+def link_securities(writer, enricher: SecurityEnricher, positions: list[dict]):
+    """Queue metadata for the positions' securities and drop links that cannot resolve."""
+    for security_data in enricher.lookup(p["security_id"] for p in positions):
+        upsert_security(writer, security_data)
+    for position_data in positions:
+        position_data["security_id"] = enricher.resolve(position_data["security_id"])
+
+
+def sync_securities(writer, enricher: SecurityEnricher, security_ids: set[str]) -> int:
+    """Look up securities seen only in activities and report the run's enrichment."""
+    print("\nEnriching securities...")
+    rows = enricher.lookup(security_ids)
+    for security_data in rows:
+        upsert_security(writer, security_data)
+    print(f"  → {enricher.looked_up} looked up, {enricher.skipped} skipped as fresh or already fetched")
+    return enricher.looked_up
+
+
+def sync_accounts(ws, writer) -> list[dict]:
+    """Fetch and upsert all WS accounts. Return list of account dicts."""
+    print("\nFetching accounts...")
+
+    accounts = []
+    for account_data in normalize_accounts(fetch_accounts(ws)):
+        upsert_account(writer, account_data)
         accounts.append(account_data)
         print(f"  [{account_data['type']}] {account_data['nickname'] or account_data['id']}: ${account_data['netliquidation']}")
 
@@ -305,312 +1730,1959 @@ def sync_accounts(ws, cur) -> list[dict]:
     return accounts
 
 
-def sync_positions(ws, cur, accounts: list[dict]) -> int:
-    """Fetch and upsert positions for each account."""
+def sync_positions(ws, writer, accounts: list[dict], enricher: SecurityEnricher | None = None,
+                   checkpoints: Checkpoints | None = None) -> int:
+    """Fetch each account's positions and replace its stored holdings with them.
+
+    An account is only replaced once its positions were fetched in full, so a
+    failed fetch keeps the previous holdings rather than deleting them. With
+    an ``enricher``, the positions' securities are looked up and written first.
+    """
     print("\nFetching positions...")
     total = 0
 
     for acc in accounts:
         try:
-            raw_positions = ws.get_positions(acc["id"])
-            positions = raw_positions.get("results", raw_positions if isinstance(raw_positions, list) else [])
-
-            for pos in positions:
-                stock = pos.get("stock", {}) or {}
-                symbol = (
-                    stock.get("symbol")
-                    or pos.get("symbol")
-                    or pos.get("securitySymbol")
-                    or "UNKNOWN"
-                )
-
-                quantity = safe_decimal(pos.get("quantity", 0))
-                book_value = safe_decimal(
-                    pos.get("bookValue", {}).get("amount")
-                    if isinstance(pos.get("bookValue"), dict)
-                    else pos.get("bookValue", 0)
-                )
-                market_value = safe_decimal(
-                    pos.get("marketValue", {}).get("amount")
-                    if isinstance(pos.get("marketValue"), dict)
-                    else pos.get("marketValue", 0)
-                )
-                gain_loss = market_value - book_value
-                gain_loss_pct = (gain_loss / book_value * 100) if book_value else Decimal("0")
-
-                import uuid
-                position_data = {
-                    "id": str(uuid.uuid4())[:25],
-                    "account_id": acc["id"],
-                    "security_id": stock.get("securityId") or pos.get("securityId"),
-                    "symbol": symbol,
-                    "name": stock.get("name") or pos.get("securityName") or symbol,
-                    "quantity": quantity,
-                    "book_value": book_value,
-                    "market_value": market_value,
-                    "gain_loss": gain_loss,
-                    "gain_loss_pct": gain_loss_pct,
-                    "currency": pos.get("currency", acc.get("currency", "CAD")),
-                }
-
-                upsert_position(cur, position_data)
-                total += 1
-                print(f"    {symbol}: {quantity} units, MV=${market_value}")
-
+            positions = list(normalize_positions(acc, fetch_positions(ws, acc)))
         except Exception as e:
             print(f"  Warning: Could not fetch positions for {acc['id']}: {e}")
+            if checkpoints:
+                upsert_checkpoint(writer, checkpoints.failed("positions", acc["id"], e))
+            continue
+
+        if enricher:
+            link_securities(writer, enricher, positions)
+        replace_positions(writer, acc["id"], positions)
+        if checkpoints:
+            upsert_checkpoint(writer, checkpoints.done("positions", acc["id"], len(positions)))
+        total += len(positions)
+        for position_data in positions:
+            logger.debug("    %s: %s units, MV=$%s", position_data["symbol"],
+                         position_data["quantity"], position_data["market_value"])
 
     print(f"  → {total} positions synced")
     return total
 
 
-def sync_historical(ws, cur, accounts: list[dict]) -> int:
-    """Fetch and upsert historical daily snapshots."""
+# History windows accepted by get_historical_financials, smallest first, with
+# the number of days each one is guaranteed to cover.
+HISTORY_WINDOWS = [("1d", 1), ("1w", 7), ("1m", 28), ("3m", 89), ("1y", 365)]
+
+
+def history_window(last_date: str | None) -> str:
+    """Pick the smallest history window that reaches back to ``last_date``."""
+    if last_date:
+        gap = (date.today() - date.fromisoformat(last_date)).days
+        for window, days in HISTORY_WINDOWS:
+            if gap <= days:
+                return window
+    return HISTORY_WINDOWS[-1][0]
+
+
+def sync_historical(ws, writer, accounts: list[dict], since: dict[str, str] | None = None,
+                    checkpoints: Checkpoints | None = None) -> int:
+    """Fetch and upsert historical daily snapshots.
+
+    When ``since`` maps an account ID to its latest stored snapshot date,
+    only the window covering that gap is fetched and only dates on or after
+    it are written.
+    """
     print("\nFetching historical data...")
     total = 0
+    since = since or {}
 
     for acc in accounts:
+        cutoff = since.get(acc["id"])
+        written = 0
         try:
-            # Try to get historical financials
-            history = ws.get_historical_financials(acc["id"], "1y")
-            results = history.get("results", history if isinstance(history, list) else [])
-
-            for entry in results:
-                entry_date = entry.get("date")
-                if not entry_date:
-                    continue
-
-                if isinstance(entry_date, str):
-                    entry_date = entry_date[:10]  # YYYY-MM-DD
-
-                import uuid
-                snapshot_data = {
-                    "id": str(uuid.uuid4())[:25],
-                    "account_id": acc["id"],
-                    "date": entry_date,
-                    "netliquidation": safe_decimal(
-                        entry.get("value", {}).get("amount")
-                        if isinstance(entry.get("value"), dict)
-                        else entry.get("value", 0)
-                    ),
-                    "deposits": safe_decimal(
-                        entry.get("deposits", {}).get("amount")
-                        if isinstance(entry.get("deposits"), dict)
-                        else entry.get("deposits", 0)
-                    ),
-                    "withdrawals": safe_decimal(
-                        entry.get("withdrawals", {}).get("amount")
-                        if isinstance(entry.get("withdrawals"), dict)
-                        else entry.get("withdrawals", 0)
-                    ),
-                    "earnings": safe_decimal(
-                        entry.get("earnings", {}).get("amount")
-                        if isinstance(entry.get("earnings"), dict)
-                        else entry.get("earnings", 0)
-                    ),
-                }
-
-                upsert_snapshot(cur, snapshot_data)
-                total += 1
-
-            print(f"  {acc['type']}: {len(results)} data points")
-
+            entries = fetch_history(ws, acc, history_window(cutoff))
+            for snapshot_data in normalize_snapshots(acc, entries, cutoff):
+                upsert_snapshot(writer, snapshot_data)
+                written += 1
+
+            if cutoff:
+                print(f"  {acc['type']}: {written} data points since {cutoff}")
+            else:
+                print(f"  {acc['type']}: {written} data points")
+            if checkpoints:
+                upsert_checkpoint(writer, checkpoints.done("historical", acc["id"], written))
+
+        except psycopg2.Error:
+            # Raised by the writer, not the API: the whole run fails, not this account.
+            raise
         except Exception as e:
             print(f"  Warning: Could not fetch history for {acc['id']}: {e}")
+            if checkpoints:
+                upsert_checkpoint(writer, checkpoints.failed("historical", acc["id"], e))
+        total += written
 
     print(f"  → {total} snapshots synced")
     return total
 
 
-def sync_activities(ws, cur, accounts: list[dict]) -> tuple[int, int]:
-    """Fetch all activities, upsert, and extract dividends."""
+def sync_activities(ws, writer, accounts: list[dict], since: dict[str, str] | None = None,
+                    security_ids: set[str] | None = None,
+                    checkpoints: Checkpoints | None = None,
+                    page_size: int = ACTIVITY_PAGE_SIZE) -> tuple[int, int]:
+    """Fetch all activities and upsert them. Return the activity and dividend counts.
+
+    Activities are fetched ``page_size`` at a time and each page is handed
+    to the writer before the next is requested, so memory stays flat
+    however long an account's history is. When ``since`` maps an account
+    ID to a YYYY-MM-DD cutoff, only that account's activities on or after
+    the cutoff are fetched and written. The security IDs of written
+    activities are added to ``security_ids``. Dividends are derived from
+    them afterwards by derive_dividends(); the count here is of the dividend
+    payments among the activities written.
+    """
     print("\nFetching activities...")
-    activity_total = 0
-    dividend_total = 0
+    activity_total = dividend_total = 0
+    since = since or {}
 
     for acc in accounts:
+        cutoff = since.get(acc["id"])
+        written = dividends = 0
         try:
-            raw_activities = ws.get_activities(acc["id"])
-            activities = raw_activities.get("results", raw_activities if isinstance(raw_activities, list) else [])
+            for page in fetch_activity_pages(ws, acc, page_size, cutoff):
+                for activity_data in normalize_activities(acc, page, cutoff):
+                    upsert_activity(writer, activity_data)
+                    written += 1
+                    dividends += is_dividend_payment(activity_data)
+                    if security_ids is not None and activity_data["security_id"]:
+                        security_ids.add(activity_data["security_id"])
+
+            if cutoff:
+                print(f"  {acc['type']}: {written} activities since {cutoff}")
+            else:
+                print(f"  {acc['type']}: {written} activities")
+            if checkpoints:
+                upsert_checkpoint(writer, checkpoints.done("activities", acc["id"], written))
+
+        except psycopg2.Error:
+            # Raised by the writer, not the API: the whole run fails, not this account.
+            raise
+        except Exception as e:
+            print(f"  Warning: Could not fetch activities for {acc['id']}: {e}")
+            if checkpoints:
+                upsert_checkpoint(writer, checkpoints.failed("activities", acc["id"], e))
+        activity_total += written
+        dividend_total += dividends
+
+    print(f"  → {activity_total} activities, {dividend_total} dividends synced")
+    return activity_total, dividend_total
+
+
+def is_dividend_payment(activity: dict) -> bool:
+    """Whether derive_dividends() turns this activity into a dividend payment."""
+    return activity["type"] == "dividend" and bool(activity["symbol"]) and bool(activity["amount"])
+
+
+# Merge dividends from dividend activities in one statement, classifying
+# each (account, symbol) by its average gap between payments as it goes.
+# Payments on the same day are summed into one, in the earliest one's
+# currency. ``{scope}`` limits the accounts; the upsert is the dividends
+# entry of UPSERTS, so unchanged rows are not rewritten. New rows get IDs
+# shaped like new_row_id()'s. A corrected amount is rewritten, but a
+# payment whose activities are gone keeps its row: dividends also holds
+# rows the dashboard's SnapTrade import writes, with no activity behind
+# them to match.
+DERIVE_DIVIDENDS_SQL = """
+    WITH payments AS (
+        SELECT "accountId", symbol, SUM(ABS(amount)) AS amount,
+               (array_agg(currency ORDER BY "occurredAt", id))[1] AS currency,
+               "occurredAt"::date AS "paymentDate"
+        FROM activities
+        WHERE type = 'dividend' AND symbol <> '' AND amount <> 0
+          {scope}
+        GROUP BY "accountId", symbol, "occurredAt"::date
+    ),
+    gaps AS (
+        SELECT *, "paymentDate" - LAG("paymentDate") OVER (
+                      PARTITION BY "accountId", symbol ORDER BY "paymentDate"
+                  ) AS gap_days
+        FROM payments
+    ),
+    classified AS (
+        SELECT substr(md5(random()::text || clock_timestamp()::text), 1, 25),
+               "accountId", symbol, amount, currency, "paymentDate",
+               CASE
+                   WHEN AVG(gap_days) OVER pair IS NULL THEN NULL
+                   WHEN AVG(gap_days) OVER pair <= 45 THEN 'monthly'
+                   WHEN AVG(gap_days) OVER pair <= 120 THEN 'quarterly'
+                   WHEN AVG(gap_days) OVER pair <= 210 THEN 'semi-annual'
+                   ELSE 'annual'
+               END
+        FROM gaps
+        WINDOW pair AS (PARTITION BY "accountId", symbol)
+    ),
+    written AS ({upsert})
+    SELECT (SELECT count(*) FROM classified), w.*
+    FROM (SELECT 1) AS one LEFT JOIN written w ON true
+""".replace("{upsert}", UPSERTS["dividends"][0].replace("VALUES %s", "SELECT * FROM classified")
+                                               .replace("RETURNING (xmax = 0)", "RETURNING (xmax = 0) AS inserted"))
+
+# Accounts with a dividend activity not yet merged, so a run that failed
+# between writing activities and deriving dividends is caught up next time.
+# Only activities since each account's cutoff (see ACTIVITY_CUTOFFS_SQL)
+# are checked, as only those are resynced; older gaps need
+# --recompute-frequencies.
+UNMERGED_DIVIDEND_ACCOUNTS_SQL = f"""
+    SELECT a."accountId" FROM activities a
+    JOIN ({ACTIVITY_CUTOFFS_SQL}) AS c("accountId", cutoff) ON c."accountId" = a."accountId"
+    WHERE a.type = 'dividend' AND a.symbol <> '' AND a.amount <> 0
+      AND a."occurredAt" >= c.cutoff
+      AND NOT EXISTS (SELECT 1 FROM dividends d
+                      WHERE d."accountId" = a."accountId" AND d.symbol = a.symbol
+                        AND d."paymentDate" = a."occurredAt"::date)
+"""
+
 
-            for act in activities:
-                act_id = act.get("id", act.get("canonicalId", ""))
-                if not act_id:
+def derive_dividends_query(account_ids: set[str] | None,
+                           overlap_days: int = DEFAULT_OVERLAP_DAYS) -> tuple[str, tuple]:
+    """Build the derivation for ``account_ids`` and any unmerged ones; None derives every account."""
+    if account_ids is None:
+        return DERIVE_DIVIDENDS_SQL.replace("{scope}", ""), ()
+    scope = f"""AND ("accountId" = ANY(%s) OR "accountId" IN ({UNMERGED_DIVIDEND_ACCOUNTS_SQL}))"""
+    return DERIVE_DIVIDENDS_SQL.replace("{scope}", scope), (sorted(account_ids), overlap_days)
+
+
+def record_derived_dividends(rows: list[tuple], seconds: float, touched: dict[str, set] | None,
+                             metrics: SyncMetrics | None) -> int:
+    """Record the rows a derivation wrote like BulkWriter does. Return how many were derived."""
+    derived = rows[0][0]
+    written = [row[1:] for row in rows if row[1] is not None]
+    if touched is not None and written:
+        touched.setdefault("dividends", set()).update(tuple(row[1:]) for row in written)
+    inserted = sum(1 for row in written if row[0])
+    if metrics:
+        metrics.record_write("dividends", derived, seconds, inserted=inserted,
+                             updated=len(written) - inserted)
+    print(f"  → {derived} dividends derived: {inserted} new, {len(written) - inserted} updated")
+    return derived
+
+
+def touched_activity_accounts(touched: dict[str, set]) -> set[str]:
+    """The accounts with activities written this run."""
+    return {account_id for account_id, _ in touched.get("activities", ())}
+
+
+def derive_dividends(cur, account_ids: set[str] | None = None, touched: dict[str, set] | None = None,
+                     metrics: SyncMetrics | None = None, overlap_days: int = DEFAULT_OVERLAP_DAYS) -> int:
+    """Merge ``dividends`` from the dividend activities of ``account_ids``, with frequencies.
+
+    Each account's whole dividend history is derived, so frequencies see
+    every payment. None derives every account; otherwise accounts with
+    dividend activities unmerged within ``overlap_days`` of their latest
+    activity are derived too. Written rows are added to
+    ``touched``. Returns the number of rows derived, written or not.
+    """
+    print("\nDeriving dividends...")
+    started = time.perf_counter()
+    cur.execute(*derive_dividends_query(account_ids, overlap_days))
+    return record_derived_dividends(cur.fetchall(), time.perf_counter() - started, touched, metrics)
+
+
+def touched_dividend_pairs(touched: dict[str, set]) -> set[tuple[str, str]]:
+    """The (accountId, symbol) pairs of dividends written this run."""
+    return {(account_id, symbol) for account_id, symbol, _ in touched.get("dividends", ())}
+
+
+# ---------------------------------------------------------------------------
+# Backfill
+# ---------------------------------------------------------------------------
+
+# Earliest date a backfill reaches for when an account has no opening date.
+BACKFILL_EARLIEST = "2014-01-01"
+BACKFILL_KINDS = ("history", "activities")
+
+COMPLETED_WINDOWS_SQL = """
+    SELECT "accountId", kind, "startDate", "endDate"
+    FROM backfill_windows
+"""
+
+
+def backfill_windows(first_day: date, chunk_days: int, today: date | None = None) -> list[tuple[date, date]]:
+    """Split ``first_day``..``today`` into inclusive windows of ``chunk_days`` days."""
+    today = today or date.today()
+    windows = []
+    start = first_day
+    while start <= today:
+        end = min(start + timedelta(days=chunk_days - 1), today)
+        windows.append((start, end))
+        start = end + timedelta(days=1)
+    return windows
+
+
+def fetch_window(ws, acc: dict, kind: str, start: date, end: date,
+                 page_size: int = ACTIVITY_PAGE_SIZE) -> list[dict]:
+    """Fetch and normalize one account's history or activities for a date window.
+
+    Both requests carry the window's bounds. Rows outside the window are
+    dropped, so an API that ignores the range still yields each row from
+    exactly one window.
+    """
+    last = end.isoformat()
+    if kind == "history":
+        rows = normalize_snapshots(acc, fetch_history_range(ws, acc, start, end), start.isoformat())
+        return [row for row in rows if str(row["date"])[:10] <= last]
+    rows = normalize_activities(acc, fetch_activities_range(ws, acc, start, end, page_size),
+                                start.isoformat())
+    return [row for row in rows if row["occurred_at"][:10] <= last]
+
+
+def backfill(ws, writer, conn, accounts: list[dict], args,
+             security_ids: set[str] | None = None) -> tuple[int, int, int]:
+    """Fetch each account's full history and activities in parallel date windows.
+
+    Every finished window is committed together with its backfill_windows
+    checkpoint, so an interrupted backfill resumes with the windows still
+    missing. Windows reaching today are never checkpointed, as they are
+    still filling up. Returns the snapshot, activity and dividend counts.
+    """
+    print("\nBackfilling history and activities...")
+    cur = conn.cursor()
+    cur.execute(COMPLETED_WINDOWS_SQL)
+    completed = {(a, kind, start, end) for a, kind, start, end in cur.fetchall()}
+    cur.close()
+
+    today = date.today()
+    jobs = []
+    for acc in accounts:
+        first_day = date.fromisoformat(str(acc.get("created_at") or args.backfill_from)[:10])
+        for start, end in backfill_windows(first_day, args.backfill_chunk_days, today):
+            for kind in BACKFILL_KINDS:
+                if (acc["id"], kind, start, end) not in completed:
+                    jobs.append((acc, kind, start, end))
+    print(f"  {len(jobs)} windows to fetch across {len(accounts)} accounts")
+
+    snapshots = activities = dividends = failed = 0
+    pool = ThreadPoolExecutor(max(1, args.concurrency), thread_name_prefix="ws-backfill")
+    try:
+        futures = {pool.submit(fetch_window, ws, *job, args.page_size): job for job in jobs}
+        for future in as_completed(futures):
+            acc, kind, start, end = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                print(f"  Warning: Could not fetch {kind} for {acc['id']} {start}..{end}: {e}")
+                failed += 1
+                continue
+
+            for row in rows:
+                if kind == "history":
+                    upsert_snapshot(writer, row)
                     continue
+                upsert_activity(writer, row)
+                dividends += is_dividend_payment(row)
+                if security_ids is not None and row["security_id"]:
+                    security_ids.add(row["security_id"])
+            if kind == "history":
+                snapshots += len(rows)
+            else:
+                activities += len(rows)
+
+            if end < today:
+                writer.add("backfill_windows", {
+                    "account_id": acc["id"], "kind": kind,
+                    "start_date": start, "end_date": end, "rows": len(rows),
+                })
+            writer.flush()
+            conn.commit()
+            logger.debug("  %s %s %s..%s: %d rows", acc["type"], kind, start, end, len(rows))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
-                act_type = normalize_activity_type(
-                    act.get("type", act.get("activityType", "unknown"))
-                )
-                symbol = act.get("symbol") or act.get("securitySymbol")
-                amount_raw = act.get("amount") or act.get("netAmount") or {}
-                amount = safe_decimal(
-                    amount_raw.get("amount") if isinstance(amount_raw, dict) else amount_raw
-                )
+    print(f"  → {snapshots} snapshots, {activities} activities, {dividends} dividends backfilled"
+          + (f", {failed} windows failed (rerun --backfill to retry)" if failed else ""))
+    return snapshots, activities, dividends
 
-                occurred_at = act.get("occurredAt") or act.get("processDate") or act.get("createdAt")
-                if isinstance(occurred_at, str) and len(occurred_at) >= 10:
-                    pass  # keep as string, psycopg2 handles it
-                else:
-                    occurred_at = datetime.now().isoformat()
-
-                quantity_raw = act.get("quantity")
-                price_raw = act.get("price") or act.get("marketPrice") or {}
-
-                activity_data = {
-                    "id": act_id,
-                    "account_id": acc["id"],
-                    "type": act_type,
-                    "symbol": symbol,
-                    "description": act.get("description") or act.get("subHeader"),
-                    "quantity": safe_decimal(quantity_raw) if quantity_raw else None,
-                    "price": safe_decimal(
-                        price_raw.get("amount") if isinstance(price_raw, dict) else price_raw
-                    ) if price_raw else None,
-                    "amount": amount,
-                    "currency": (
-                        amount_raw.get("currency") if isinstance(amount_raw, dict) else None
-                    ) or acc.get("currency", "CAD"),
-                    "occurred_at": occurred_at,
-                }
-
-                upsert_activity(cur, activity_data)
-                activity_total += 1
 
-                # Extract dividends
-                if act_type == "dividend" and symbol and amount:
-                    import uuid
-                    payment_date = occurred_at[:10] if isinstance(occurred_at, str) else str(occurred_at)[:10]
-                    dividend_data = {
-                        "id": str(uuid.uuid4())[:25],
-                        "account_id": acc["id"],
-                        "symbol": symbol,
-                        "amount": abs(amount),
-                        "currency": activity_data["currency"],
-                        "payment_date": payment_date,
-                        "frequency": None,  # Will be detected later
-                    }
-                    upsert_dividend(cur, dividend_data)
-                    dividend_total += 1
-
-            print(f"  {acc['type']}: {len(activities)} activities")
+# ---------------------------------------------------------------------------
+# Aggregates
+# ---------------------------------------------------------------------------
+
+# The first stored day and the last one before the refresh start, which seed
+# the running TWR index and Modified Dietz sums.
+PORTFOLIO_ANCHORS_SQL = """
+    SELECT date, netliquidation, deposits - withdrawals, "twrIndex", "flowWeight"
+    FROM portfolio_daily
+    WHERE date = (SELECT MIN(date) FROM portfolio_daily)
+       OR date = (SELECT MAX(date) FROM portfolio_daily WHERE date < %s)
+    ORDER BY date
+"""
+
+PORTFOLIO_TOTALS_SQL = """
+    SELECT date, SUM(netliquidation), SUM(deposits), SUM(withdrawals), SUM(earnings)
+    FROM account_snapshots
+    WHERE date >= %s
+    GROUP BY date
+    ORDER BY date
+"""
+
+DIVIDEND_TOTALS_SQL = """
+    WITH totals AS (
+        SELECT date_trunc('month', "paymentDate")::date AS month, symbol,
+               SUM(amount) AS amount, COUNT(*) AS payments
+        FROM dividends
+        WHERE "paymentDate" >= %(start)s
+        GROUP BY 1, 2
+    ),
+    removed AS (
+        DELETE FROM dividend_monthly_totals d
+        WHERE d.month >= %(start)s
+          AND NOT EXISTS (SELECT 1 FROM totals t WHERE t.month = d.month AND t.symbol = d.symbol)
+    )
+    INSERT INTO dividend_monthly_totals (month, symbol, amount, payments, "updatedAt")
+    SELECT month, symbol, amount, payments, NOW()
+    FROM totals
+    ON CONFLICT (month, symbol) DO UPDATE SET
+        amount = EXCLUDED.amount,
+        payments = EXCLUDED.payments,
+        "updatedAt" = NOW()
+    WHERE (dividend_monthly_totals.amount, dividend_monthly_totals.payments)
+      IS DISTINCT FROM (EXCLUDED.amount, EXCLUDED.payments)
+"""
+
+ALLOCATIONS_SQL = """
+    WITH totals AS (
+        SELECT type, SUM(netliquidation) AS netliquidation, COUNT(*) AS accounts
+        FROM accounts
+        WHERE status = 'open'
+        GROUP BY type
+    ),
+    removed AS (
+        DELETE FROM account_type_allocations
+        WHERE "accountType" NOT IN (SELECT type FROM totals)
+    )
+    INSERT INTO account_type_allocations ("accountType", netliquidation, percentage,
+                                          "accountCount", "updatedAt")
+    SELECT type, netliquidation,
+           COALESCE(ROUND(netliquidation * 100 / NULLIF(SUM(netliquidation) OVER (), 0), 4), 0),
+           accounts, NOW()
+    FROM totals
+    ON CONFLICT ("accountType") DO UPDATE SET
+        netliquidation = EXCLUDED.netliquidation,
+        percentage = EXCLUDED.percentage,
+        "accountCount" = EXCLUDED."accountCount",
+        "updatedAt" = NOW()
+    WHERE (account_type_allocations.netliquidation, account_type_allocations.percentage,
+           account_type_allocations."accountCount")
+      IS DISTINCT FROM
+          (EXCLUDED.netliquidation, EXCLUDED.percentage, EXCLUDED."accountCount")
+"""
 
+
+def refresh_portfolio_daily(cur, writer: BulkWriter, start: date | None) -> int:
+    """Recompute portfolio_daily from ``start``, or from the first snapshot when None.
+
+    Snapshot deposits and withdrawals are cumulative, so a day's external
+    flow is the change in net contributions. The daily return treats that
+    flow as arriving at the start of the day. Returns the number of days
+    computed.
+    """
+    first = prior = None
+    if start is not None:
+        cur.execute(PORTFOLIO_ANCHORS_SQL, (start,))
+        anchors = cur.fetchall()
+        if anchors and anchors[0][0] < start:
+            first, prior = anchors[0], anchors[-1]
+
+    if first:
+        first_day, first_value, first_contributions = first[0], float(first[1]), float(first[2])
+        prev_value, prev_contributions = float(prior[1]), float(prior[2])
+        index, weight = float(prior[3]), float(prior[4])
+
+    cur.execute(PORTFOLIO_TOTALS_SQL, (start or date.min,))
+    days = 0
+    for day, value, deposits, withdrawals, earnings in cur.fetchall():
+        contributions = float(deposits - withdrawals)
+        if not first:
+            first = True
+            first_day, first_value, first_contributions = day, float(value), contributions
+            flow, daily_return, index, weight = 0.0, 0.0, 1.0, 0.0
+        else:
+            flow = contributions - prev_contributions
+            base = prev_value + flow
+            daily_return = float(value) / base - 1 if base > 0 else 0.0
+            index *= 1 + daily_return
+            weight += flow * (day - first_day).days
+
+        # Modified Dietz: each flow is weighted by the share of the period it was invested.
+        elapsed = (day - first_day).days
+        net_flows = contributions - first_contributions
+        invested = first_value + net_flows - (weight / elapsed if elapsed else 0.0)
+        mwr = (float(value) - first_value - net_flows) / invested if elapsed and invested > 0 else 0.0
+
+        writer.add("portfolio_daily", {
+            "date": day,
+            "netliquidation": value,
+            "deposits": deposits,
+            "withdrawals": withdrawals,
+            "earnings": earnings,
+            "net_flow": round(flow, 2),
+            "daily_return": round(daily_return, 8),
+            "twr_index": round(index, 8),
+            "mwr_return": round(mwr, 8),
+            "flow_weight": round(weight, 2),
+        })
+        prev_value, prev_contributions = float(value), contributions
+        days += 1
+    return days
+
+
+def refresh_aggregates(conn, touched: dict[str, set], rebuild: bool = False,
+                       batch_size: int = DEFAULT_BATCH_SIZE, metrics: SyncMetrics | None = None):
+    """Bring the dashboard's summary tables up to date with this run's writes.
+
+    Only days and months from the earliest snapshot or dividend written in
+    this run are recomputed, plus any days not yet materialized. Account
+    type allocation is small and always recomputed. ``rebuild`` recomputes
+    everything.
+    """
+    print("\nRefreshing aggregates...")
+    cur = conn.cursor()
+    writer = BulkWriter(conn.cursor(), batch_size, metrics)
+
+    snapshot_start = None
+    if not rebuild:
+        cur.execute("SELECT MAX(date) FROM portfolio_daily")
+        (last_day,) = cur.fetchone()
+        if last_day:
+            changed = [d for _, d in touched.get("account_snapshots", ())]
+            snapshot_start = min(changed + [last_day + timedelta(days=1)])
+    days = refresh_portfolio_daily(cur, writer, snapshot_start)
+    writer.flush()
+
+    # Dividends are only ever added, so months before the earliest new
+    # payment keep their totals.
+    paid = [payment for _, _, payment in touched.get("dividends", ())]
+    cur.execute("SELECT EXISTS (SELECT 1 FROM dividend_monthly_totals)")
+    (materialized,) = cur.fetchone()
+    if rebuild or not materialized:
+        dividend_start = date.min
+    elif paid:
+        earliest = min(paid)
+        dividend_start = date(earliest.year, earliest.month, 1)
+    else:
+        dividend_start = None
+    if dividend_start:
+        cur.execute(DIVIDEND_TOTALS_SQL, {"start": dividend_start})
+
+    cur.execute(ALLOCATIONS_SQL)
+    conn.commit()
+    cur.close()
+
+    if dividend_start is None:
+        months = "no new dividends"
+    elif dividend_start == date.min:
+        months = "dividend months rebuilt"
+    else:
+        months = f"dividend months from {dividend_start:%Y-%m}"
+    print(f"  → {days} portfolio days from {snapshot_start or 'the first snapshot'}, {months}")
+
+
+# ---------------------------------------------------------------------------
+# Export
+# ---------------------------------------------------------------------------
+
+# Columnar export: table -> (columns with their Arrow types, partition date
+# column or None for a per-account snapshot). The types mirror the Prisma
+# schema, so every partition file of a table shares one schema.
+EXPORTS = {
+    "activities": (
+        (("id", "string"), ("accountId", "string"), ("type", "string"), ("symbol", "string"),
+         ("description", "string"), ("quantity", "decimal(14,6)"), ("price", "decimal(14,4)"),
+         ("amount", "decimal(14,2)"), ("currency", "string"), ("occurredAt", "timestamp[ms]")),
+        '"occurredAt"',
+    ),
+    "account_snapshots": (
+        (("accountId", "string"), ("date", "date32"), ("netliquidation", "decimal(14,2)"),
+         ("deposits", "decimal(14,2)"), ("withdrawals", "decimal(14,2)"),
+         ("earnings", "decimal(14,2)")),
+        "date",
+    ),
+    "dividends": (
+        (("accountId", "string"), ("symbol", "string"), ("amount", "decimal(14,4)"),
+         ("currency", "string"), ("paymentDate", "date32"), ("frequency", "string")),
+        '"paymentDate"',
+    ),
+    "positions": (
+        (("accountId", "string"), ("securityId", "string"), ("symbol", "string"), ("name", "string"),
+         ("quantity", "decimal(14,6)"), ("bookValue", "decimal(14,2)"),
+         ("marketValue", "decimal(14,2)"), ("gainLoss", "decimal(14,2)"),
+         ("gainLossPct", "decimal(12,4)"), ("currency", "string"), ("updatedAt", "timestamp[ms]")),
+        None,
+    ),
+}
+
+EXPORT_COMPRESSION = "zstd"
+
+
+def require_pyarrow():
+    """Return pyarrow and pyarrow.parquet, or exit if they are not installed."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        print("ERROR: pyarrow not found. Install with: pip install pyarrow")
+        sys.exit(1)
+    return pyarrow, pyarrow.parquet
+
+
+def arrow_schema(pa, columns) -> "pyarrow.Schema":
+    def arrow_type(spec: str):
+        if spec.startswith("decimal("):
+            precision, scale = spec[len("decimal("):-1].split(",")
+            return pa.decimal128(int(precision), int(scale))
+        return pa.type_for_alias(spec)
+    return pa.schema([(name, arrow_type(spec)) for name, spec in columns])
+
+
+def export_partitions(cur, root: str, touched: dict[str, set], full: bool = False,
+                      all_dividends: bool = False) -> dict[str, set[tuple[str, int]]]:
+    """Return the (accountId, year) partitions to rewrite for each dated table.
+
+    Only partitions this run wrote to are included, unless ``full`` is set
+    or the table has never been exported. Dividend frequencies are
+    recomputed per (account, symbol) across all years, so every year of a
+    touched pair is included; ``all_dividends`` includes them all.
+    """
+    partitions = {}
+    for table, (_, date_column) in EXPORTS.items():
+        if date_column is None:
+            continue
+        if full or not os.path.isdir(os.path.join(root, table)) or (table == "dividends" and all_dividends):
+            cur.execute(f"""
+                SELECT DISTINCT "accountId", date_part('year', {date_column})::int FROM {table}
+            """)
+            partitions[table] = set(cur.fetchall())
+        elif table == "activities":
+            partitions[table] = set(touched.get("activities", ()))
+        elif table == "account_snapshots":
+            partitions[table] = {(a, d.year) for a, d in touched.get("account_snapshots", ())}
+        else:
+            pairs = touched_dividend_pairs(touched)
+            partitions[table] = set()
+            if pairs:
+                account_ids, symbols = zip(*pairs)
+                cur.execute("""
+                    SELECT DISTINCT "accountId", date_part('year', "paymentDate")::int FROM dividends
+                    WHERE ("accountId", symbol) IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+                """, (list(account_ids), list(symbols)))
+                partitions[table] = set(cur.fetchall())
+    return partitions
+
+
+def write_parquet(pa, pq, path: str, schema, rows: list[tuple]):
+    """Atomically replace ``path`` with ``rows``, so readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    columns = list(zip(*rows)) if rows else [[] for _ in schema]
+    table = pa.Table.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema,
+    )
+    pq.write_table(table, path + ".tmp", compression=EXPORT_COMPRESSION)
+    os.replace(path + ".tmp", path)
+
+
+def export_parquet(conn, root: str, touched: dict[str, set], full: bool = False,
+                   all_dividends: bool = False) -> int:
+    """Write synced tables to Parquet under ``root``, partitioned by account and year.
+
+    Files are laid out Hive-style as <table>/account=<id>/year=<yyyy>/part-0.parquet
+    (positions: <table>/account=<id>/part-0.parquet) and only the partitions
+    this run touched are rewritten, each from the database in one query.
+    Positions are small and always rewritten whole. Returns the rows written.
+    """
+    pa, pq = require_pyarrow()
+    print(f"\nExporting to {root}...")
+    cur = conn.cursor()
+    rows_written = files = 0
+
+    for table, years in export_partitions(cur, root, touched, full, all_dividends).items():
+        columns, date_column = EXPORTS[table]
+        schema = arrow_schema(pa, columns)
+        select = ", ".join(f'"{name}"' for name, _ in columns)
+        for account_id, year in sorted(years):
+            cur.execute(f"""
+                SELECT {select} FROM {table}
+                WHERE "accountId" = %s AND {date_column} >= %s AND {date_column} < %s
+                ORDER BY {date_column}
+            """, (account_id, date(year, 1, 1), date(year + 1, 1, 1)))
+            rows = cur.fetchall()
+            path = os.path.join(root, table, f"account={account_id}", f"year={year}", "part-0.parquet")
+            write_parquet(pa, pq, path, schema, rows)
+            rows_written += len(rows)
+            files += 1
+
+    columns, _ = EXPORTS["positions"]
+    schema = arrow_schema(pa, columns)
+    cur.execute(f"""
+        SELECT {", ".join(f'"{name}"' for name, _ in columns)} FROM positions
+        ORDER BY "accountId", symbol
+    """)
+    by_account = {}
+    for row in cur.fetchall():
+        by_account.setdefault(row[0], []).append(row)
+    positions_dir = os.path.join(root, "positions")
+    for account_id, rows in by_account.items():
+        write_parquet(pa, pq, os.path.join(positions_dir, f"account={account_id}", "part-0.parquet"),
+                      schema, rows)
+        rows_written += len(rows)
+        files += 1
+    # Accounts that no longer hold anything keep no stale positions file.
+    for entry in os.listdir(positions_dir) if os.path.isdir(positions_dir) else ():
+        if entry.startswith("account=") and entry[len("account="):] not in by_account:
+            stale = os.path.join(positions_dir, entry, "part-0.parquet")
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    cur.close()
+    print(f"  → {rows_written} rows in {files} partition files")
+    return rows_written
+
+
+# ---------------------------------------------------------------------------
+# Quotes
+# ---------------------------------------------------------------------------
+
+# A quote provider has get_quotes(symbols), which fetches many Yahoo Finance
+# symbols in one request and returns {symbol: quote} with quotes using
+# Yahoo's field names (regularMarketPrice, fiftyTwoWeekHigh, fiftyTwoWeekLow,
+# and optionally currency). Symbols it has no quote for are left out. These are trimmed
+# daily closes, not the full live quotes the dashboard caches, so they are
+# kept in quote_cache under their own keys (see quote_cache_key).
+QUOTE_BATCH_SIZE = 50
+QUOTE_TTL_MINUTES = 15
+QUOTE_CACHE_PREFIX = "close:"
+
+HELD_SYMBOLS_SQL = """
+    SELECT DISTINCT p.symbol, s.exchange, s.currency
+    FROM positions p
+    LEFT JOIN securities s ON s.symbol = p.symbol
+    WHERE p.quantity <> 0
+"""
+
+CACHED_QUOTES_SQL = """
+    SELECT symbol FROM quote_cache
+    WHERE symbol = ANY(%s) AND "fetchedAt" >= NOW() - %s * interval '1 minute'
+"""
+
+# Reprice securities and positions from quote_cache in one statement. Only
+# rows whose price moved are written. securities."updatedAt" is left alone:
+# it dates the WS metadata and drives --security-ttl. A quote is only
+# applied to rows in its own currency: the quote's, else the listing's from
+# securities (see listing_currency). A quote with neither is skipped.
+QUOTE_PRICES_SQL = """
+    WITH quotes AS (
+        SELECT m.symbol, q."fetchedAt",
+               (q.data->>'regularMarketPrice')::numeric AS price,
+               (q.data->>'fiftyTwoWeekHigh')::numeric AS high,
+               (q.data->>'fiftyTwoWeekLow')::numeric AS low,
+               COALESCE(q.data->>'currency', m.currency) AS currency
+        FROM unnest(%s::text[], %s::text[], %s::text[]) AS m(symbol, "cacheKey", currency)
+        JOIN quote_cache q ON q.symbol = m."cacheKey"
+        WHERE q.data->>'regularMarketPrice' IS NOT NULL
+    ),
+    repriced_securities AS (
+        UPDATE securities s SET
+            "currentPrice" = q.price,
+            "fiftyTwoWeekHigh" = COALESCE(q.high, s."fiftyTwoWeekHigh"),
+            "fiftyTwoWeekLow" = COALESCE(q.low, s."fiftyTwoWeekLow"),
+            "priceUpdatedAt" = q."fetchedAt"
+        FROM quotes q
+        WHERE s.symbol = q.symbol
+          AND q.currency = s.currency
+          AND (s."currentPrice", s."priceUpdatedAt") IS DISTINCT FROM (q.price, q."fetchedAt")
+        RETURNING 1
+    ),
+    repriced_positions AS (
+        UPDATE positions p SET
+            "marketValue" = ROUND(p.quantity * q.price, 2),
+            "gainLoss" = ROUND(p.quantity * q.price, 2) - p."bookValue",
+            "gainLossPct" = CASE WHEN p."bookValue" <> 0
+                                 THEN ROUND((ROUND(p.quantity * q.price, 2) - p."bookValue")
+                                            * 100 / p."bookValue", 4)
+                                 ELSE 0 END,
+            "updatedAt" = NOW()
+        FROM quotes q
+        WHERE p.symbol = q.symbol
+          AND q.currency = p.currency
+          AND p."marketValue" IS DISTINCT FROM ROUND(p.quantity * q.price, 2)
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM repriced_securities), (SELECT count(*) FROM repriced_positions)
+"""
+
+TSX_EXCHANGES = {"TSX", "TSE", "XTSE", "XTOR", "XTSX"}
+TSXV_EXCHANGES = {"TSXV", "XTSX-V", "CVE"}
+
+
+def yahoo_symbol(symbol: str, exchange: str | None) -> str:
+    """Map a stored symbol to Yahoo Finance's, as the dashboard does: TSX listings get .TO."""
+    if "." in symbol:
+        return symbol
+    if exchange and exchange.upper() in TSX_EXCHANGES:
+        return f"{symbol}.TO"
+    if exchange and exchange.upper() in TSXV_EXCHANGES:
+        return f"{symbol}.V"
+    return symbol
+
+
+def listing_currency(exchange: str | None, currency: str | None) -> str | None:
+    """The currency a stored security's Yahoo quote is in, or None if unknown.
+
+    securities.currency is the listing's currency, but only a known exchange
+    pins which listing yahoo_symbol asks for: a bare symbol with no exchange
+    resolves to Yahoo's US listing whatever the stored currency says.
+    """
+    return currency if exchange else None
+
+
+def quote_cache_key(yahoo_symbol: str) -> str:
+    """The quote_cache key for a Yahoo symbol's daily close.
+
+    The dashboard caches full live quotes keyed by the bare symbol; a
+    different key keeps it from reading these trimmed ones as its own.
+    """
+    return QUOTE_CACHE_PREFIX + yahoo_symbol
+
+
+class YahooQuoteProvider:
+    """Fetch quotes from Yahoo Finance with yfinance, one download per batch.
+
+    The price is the last daily close, not a live quote, and the 52-week
+    range comes from the same year of daily bars, so a batch's prices cost a
+    single download call. Daily bars carry no currency; refresh_quotes takes
+    it from the stored listing instead (see listing_currency).
+    """
+
+    def __init__(self):
+        try:
+            import yfinance
+        except ImportError:
+            print("ERROR: yfinance not found. Install with: pip install yfinance")
+            sys.exit(1)
+        self.yf = yfinance
+
+    def get_quotes(self, symbols: list[str]) -> dict[str, dict]:
+        frame = self.yf.download(
+            symbols, period="1y", interval="1d", group_by="ticker",
+            auto_adjust=False, progress=False, threads=False,
+        )
+        quotes = {}
+        for symbol in symbols:
+            try:
+                bars = frame[symbol].dropna(subset=["Close"])
+            except KeyError:
+                continue
+            if bars.empty:
+                continue
+            quotes[symbol] = {
+                "symbol": symbol,
+                "regularMarketPrice": float(bars["Close"].iloc[-1]),
+                "regularMarketTime": bars.index[-1].isoformat(),
+                "fiftyTwoWeekHigh": float(bars["High"].max()),
+                "fiftyTwoWeekLow": float(bars["Low"].min()),
+            }
+        return quotes
+
+
+class FileQuoteProvider:
+    """Serve quotes from a JSON file of {symbol: quote}, for tests and offline runs.
+
+    A quote's ``currency``, if given, overrides the stored listing's.
+    """
+
+    def __init__(self, path: str):
+        with open(path) as f:
+            self.quotes = json.load(f)
+
+    def get_quotes(self, symbols: list[str]) -> dict[str, dict]:
+        return {symbol: self.quotes[symbol] for symbol in symbols if symbol in self.quotes}
+
+
+def refresh_quotes(conn, provider, quote_batch_size: int = QUOTE_BATCH_SIZE,
+                   ttl_minutes: float = QUOTE_TTL_MINUTES, batch_size: int = DEFAULT_BATCH_SIZE,
+                   metrics: SyncMetrics | None = None) -> int:
+    """Reprice held securities and positions from batched quotes. Return positions repriced.
+
+    Quotes cached within ``ttl_minutes`` are reused; the rest are fetched
+    ``quote_batch_size`` symbols per provider call and cached. A failed
+    batch keeps its symbols' last cached quotes. Prices are applied in the
+    stored listing's currency unless the quote carries its own.
+    """
+    print("\nRefreshing quotes...")
+    cur = conn.cursor()
+    cur.execute(HELD_SYMBOLS_SQL)
+    held = cur.fetchall()
+    symbols = {symbol: yahoo_symbol(symbol, exchange) for symbol, exchange, _ in held}
+    currencies = {symbol: listing_currency(exchange, currency) for symbol, exchange, currency in held}
+    wanted = sorted(set(symbols.values()))
+    cur.execute(CACHED_QUOTES_SQL, ([quote_cache_key(symbol) for symbol in wanted], ttl_minutes))
+    cached = {key[len(QUOTE_CACHE_PREFIX):] for (key,) in cur.fetchall()}
+    stale = [symbol for symbol in wanted if symbol not in cached]
+
+    writer = BulkWriter(conn.cursor(), batch_size, metrics)
+    batches = [stale[i:i + quote_batch_size] for i in range(0, len(stale), max(1, quote_batch_size))]
+    missing = []
+    for batch in batches:
+        started = time.perf_counter()
+        try:
+            quotes = provider.get_quotes(batch)
         except Exception as e:
-            print(f"  Warning: Could not fetch activities for {acc['id']}: {e}")
+            if metrics:
+                metrics.record_api("get_quotes", time.perf_counter() - started, 0, error=True)
+            print(f"  Warning: quote batch of {len(batch)} symbols failed, keeping cached prices: {e}")
+            continue
+        if metrics:
+            metrics.record_api("get_quotes", time.perf_counter() - started,
+                               len(json.dumps(quotes, default=str)))
+        for symbol in batch:
+            if symbol not in quotes:
+                missing.append(symbol)
+                continue
+            writer.add("quote_cache", {"symbol": quote_cache_key(symbol),
+                                       "data": psycopg2.extras.Json(quotes[symbol])})
+    writer.flush()
+
+    cur.execute(QUOTE_PRICES_SQL, (list(symbols), [quote_cache_key(y) for y in symbols.values()],
+                                   [currencies[symbol] for symbol in symbols]))
+    securities_count, positions_count = cur.fetchone()
+    conn.commit()
+    cur.close()
+
+    if missing:
+        print(f"  Warning: no quote for {', '.join(missing)}")
+    unlisted = sorted(symbol for symbol, currency in currencies.items() if not currency)
+    if unlisted:
+        print(f"  Warning: no exchange for {', '.join(unlisted)}; repriced only by quotes with a currency")
+    print(f"  → {len(wanted)} symbols: {len(cached)} cached, {len(stale)} requested in {len(batches)} batches; "
+          f"{positions_count} positions and {securities_count} securities repriced")
+    return positions_count
 
+
+# ---------------------------------------------------------------------------
+# Async engine
+# ---------------------------------------------------------------------------
+
+class AsyncBulkWriter(BulkWriter):
+    """BulkWriter for a psycopg 3 async connection.
+
+    Each flush sends the batch as one multi-row upsert, as execute_values
+    does for BulkWriter, and reads its RETURNING rows once.
+    """
+
+    def __init__(self, conn, batch_size: int = DEFAULT_BATCH_SIZE, metrics: SyncMetrics | None = None,
+                 touched: dict[str, set] | None = None):
+        super().__init__(None, batch_size, metrics, touched)
+        self.conn = conn
+
+    async def add(self, table: str, row: dict):
+        if self._buffer(table, row) >= self.batch_size:
+            await self.flush(table)
+
+    async def flush(self, table: str | None = None):
+        for name, rows in self._take(table):
+            sql, template, _ = UPSERTS[name]
+            started = time.perf_counter()
+            written = []
+            async with self.conn.cursor() as cur:
+                for page in value_pages(template, rows):
+                    values, params = expand_values(template, page)
+                    await cur.execute(sql.replace("VALUES %s", f"VALUES {values}"), params)
+                    written.extend(await cur.fetchall())
+            self._record(name, len(rows), written, time.perf_counter() - started)
+
+    async def replace(self, table: str, scope, rows: list[dict]):
+        await self.flush()
+        sql, clear_sql, _ = REPLACES[table]
+        rows = self._dedupe(table, rows)
+        started = time.perf_counter()
+        async with self.conn.cursor() as cur:
+            if rows:
+                values, params = expand_values(UPSERTS[table][1], rows)
+                await cur.execute(sql.replace("VALUES %s", f"VALUES {values}"), params)
+                inserted, updated, deleted = await cur.fetchone()
+            else:
+                await cur.execute(clear_sql, (scope,))
+                inserted, updated, deleted = 0, 0, cur.rowcount
+        if self.metrics:
+            self.metrics.record_write(table, len(rows), time.perf_counter() - started,
+                                      inserted=inserted, updated=updated, deleted=deleted)
+
+
+# PostgreSQL's limit on bind parameters in one statement.
+MAX_QUERY_PARAMS = 65535
+
+
+def value_pages(template: str, rows: list[dict]):
+    """Split ``rows`` so each expanded VALUES list stays within MAX_QUERY_PARAMS."""
+    per_page = max(1, MAX_QUERY_PARAMS // max(1, len(re.findall(r"%\((\w+)\)s", template))))
+    for start in range(0, len(rows), per_page):
+        yield rows[start:start + per_page]
+
+
+def expand_values(template: str, rows: list[dict]) -> tuple[str, list]:
+    """Repeat a ``%(name)s`` row template once per row as positional placeholders.
+
+    psycopg 3 has no execute_values, so a multi-row VALUES list is built here.
+    """
+    names = re.findall(r"%\((\w+)\)s", template)
+    row_sql = re.sub(r"%\((\w+)\)s", "%s", template)
+    return ", ".join([row_sql] * len(rows)), [row[n] for row in rows for n in names]
+
+
+async def fetch_each(ws, accounts: list[dict], limit: asyncio.Semaphore, fetch, args=lambda acc: ()):
+    """Run a blocking fetcher for every account in worker threads.
+
+    ``args(acc)`` returns the extra positional arguments for each call.
+
+    Yields ``(account, records)`` in completion order, with the exception
+    in place of the records when that account's fetch failed.
+    """
+    async def one(acc):
+        async with limit:
+            try:
+                return acc, await asyncio.to_thread(lambda: list(fetch(ws, acc, *args(acc))))
+            except Exception as e:
+                return acc, e
+
+    for next_done in asyncio.as_completed([one(acc) for acc in accounts]):
+        yield await next_done
+
+
+async def stream_each(ws, accounts: list[dict], limit: asyncio.Semaphore, pages, args=lambda acc: ()):
+    """Run a blocking page generator for every account in worker threads.
+
+    Yields ``(account, page)`` as pages arrive, then ``(account, None)``
+    once an account is exhausted, or ``(account, exception)`` if its fetch
+    failed. Producers block on a small queue, so only a few pages are held
+    in memory at a time.
+    """
+    queue = asyncio.Queue(maxsize=max(1, len(accounts)))
+
+    async def produce(acc):
+        async with limit:
+            try:
+                it = pages(ws, acc, *args(acc))
+                while (page := await asyncio.to_thread(next, it, None)) is not None:
+                    await queue.put((acc, page))
+                await queue.put((acc, None))
+            except Exception as e:
+                await queue.put((acc, e))
+
+    producers = [asyncio.create_task(produce(acc)) for acc in accounts]
+    remaining = len(accounts)
+    try:
+        while remaining:
+            acc, page = await queue.get()
+            if page is None or isinstance(page, Exception):
+                remaining -= 1
+            yield acc, page
+    finally:
+        for task in producers:
+            task.cancel()
+
+
+async def async_sync_accounts(ws, pool, args, metrics: SyncMetrics) -> list[dict]:
+    print("\nFetching accounts...")
+    raw_accounts = await asyncio.to_thread(lambda: list(fetch_accounts(ws)))
+    accounts = []
+    async with pool.connection() as conn:
+        writer = AsyncBulkWriter(conn, args.batch_size, metrics)
+        for account_data in normalize_accounts(raw_accounts):
+            await writer.add("accounts", account_data)
+            accounts.append(account_data)
+            print(f"  [{account_data['type']}] {account_data['nickname'] or account_data['id']}: ${account_data['netliquidation']}")
+        await writer.flush()
+    print(f"  → {len(accounts)} accounts synced")
+    return accounts
+
+
+async def async_sync_positions(ws, pool, args, metrics, accounts, limit, checkpoints, enricher) -> int:
+    total = 0
+    async with pool.connection() as conn:
+        writer = AsyncBulkWriter(conn, args.batch_size, metrics)
+        async for acc, raw in fetch_each(ws, checkpoints.pending("positions", accounts), limit, fetch_positions):
+            if isinstance(raw, Exception):
+                print(f"  Warning: Could not fetch positions for {acc['id']}: {raw}")
+                await writer.add("sync_checkpoints", checkpoints.failed("positions", acc["id"], raw))
+                continue
+            positions = list(normalize_positions(acc, raw))
+            for security_data in await asyncio.to_thread(enricher.lookup, [p["security_id"] for p in positions]):
+                await writer.add("securities", security_data)
+            for position_data in positions:
+                position_data["security_id"] = enricher.resolve(position_data["security_id"])
+            await writer.replace("positions", acc["id"], positions)
+            await writer.add("sync_checkpoints", checkpoints.done("positions", acc["id"], len(positions)))
+            total += len(positions)
+        await writer.flush()
+    print(f"  → {total} positions synced")
+    return total
+
+
+async def async_sync_historical(ws, pool, args, metrics, accounts, limit, checkpoints, since, touched) -> int:
+    total = 0
+    async with pool.connection() as conn:
+        writer = AsyncBulkWriter(conn, args.batch_size, metrics, touched)
+        window = lambda acc: (history_window(since.get(acc["id"])),)
+        async for acc, raw in fetch_each(ws, checkpoints.pending("historical", accounts), limit,
+                                         fetch_history, window):
+            if isinstance(raw, Exception):
+                print(f"  Warning: Could not fetch history for {acc['id']}: {raw}")
+                await writer.add("sync_checkpoints", checkpoints.failed("historical", acc["id"], raw))
+                continue
+            written = 0
+            for snapshot_data in normalize_snapshots(acc, raw, since.get(acc["id"])):
+                await writer.add("account_snapshots", snapshot_data)
+                written += 1
+            print(f"  {acc['type']}: {written} data points")
+            await writer.add("sync_checkpoints", checkpoints.done("historical", acc["id"], written))
+            total += written
+        await writer.flush()
+    print(f"  → {total} snapshots synced")
+    return total
+
+
+async def async_sync_activities(ws, pool, args, metrics, accounts, limit, checkpoints, since, touched,
+                                security_ids: set[str]) -> tuple[int, int]:
+    activity_total = dividend_total = 0
+    async with pool.connection() as conn:
+        writer = AsyncBulkWriter(conn, args.batch_size, metrics, touched)
+        written = {}
+        async for acc, page in stream_each(ws, checkpoints.pending("activities", accounts), limit,
+                                           fetch_activity_pages,
+                                           lambda acc: (args.page_size, since.get(acc["id"]))):
+            if isinstance(page, Exception):
+                print(f"  Warning: Could not fetch activities for {acc['id']}: {page}")
+                await writer.add("sync_checkpoints", checkpoints.failed("activities", acc["id"], page))
+                continue
+            if page is None:
+                print(f"  {acc['type']}: {written.get(acc['id'], 0)} activities")
+                await writer.add("sync_checkpoints",
+                                 checkpoints.done("activities", acc["id"], written.get(acc["id"], 0)))
+                continue
+            for activity_data in normalize_activities(acc, page, since.get(acc["id"])):
+                await writer.add("activities", activity_data)
+                written[acc["id"]] = written.get(acc["id"], 0) + 1
+                activity_total += 1
+                dividend_total += is_dividend_payment(activity_data)
+                if activity_data["security_id"]:
+                    security_ids.add(activity_data["security_id"])
+        await writer.flush()
     print(f"  → {activity_total} activities, {dividend_total} dividends synced")
     return activity_total, dividend_total
 
 
-def detect_dividend_frequency(cur):
-    """Analyze dividend payment patterns and update frequency."""
-    print("\nDetecting dividend frequencies...")
-    cur.execute("""
-        WITH payment_gaps AS (
-            SELECT symbol, "accountId",
-                   "paymentDate" - LAG("paymentDate") OVER (
-                       PARTITION BY symbol, "accountId" ORDER BY "paymentDate"
-                   ) AS gap_days
-            FROM dividends
-        ),
-        avg_gaps AS (
-            SELECT symbol, "accountId",
-                   AVG(EXTRACT(EPOCH FROM gap_days) / 86400) AS avg_gap
-            FROM payment_gaps
-            WHERE gap_days IS NOT NULL
-            GROUP BY symbol, "accountId"
+async def _run_stages_async(ws, pool, args, metrics: SyncMetrics,
+                            checkpoints: Checkpoints) -> tuple[dict, dict]:
+    with metrics.stage("accounts"):
+        accounts = await async_sync_accounts(ws, pool, args, metrics)
+
+    async with pool.connection() as conn:
+        snapshot_since, activity_since = {}, {}
+        if not args.full:
+            cur = await conn.execute(SNAPSHOT_CUTOFFS_SQL)
+            snapshot_since = {a: d.isoformat() for a, d in await cur.fetchall()}
+            cur = await conn.execute(ACTIVITY_CUTOFFS_SQL, (args.overlap_days,))
+            activity_since = {a: d.isoformat() for a, d in await cur.fetchall()}
+        cur = await conn.execute(KNOWN_SECURITIES_SQL, (args.security_ttl,))
+        known = {security_id: (symbol, fresh) for security_id, symbol, fresh in await cur.fetchall()}
+    enricher = SecurityEnricher(ws, known, args.concurrency)
+    security_ids = set()
+    touched = {}
+
+    # Positions, history and activities are independent of each other,
+    # so all three stages run at once and share the API call limit.
+    print("\nFetching positions, historical data and activities...")
+    limit = asyncio.Semaphore(max(1, args.concurrency))
+    with metrics.stage("positions+historical+activities"):
+        positions_count, snapshots_count, (activities_count, dividends_count) = await asyncio.gather(
+            async_sync_positions(ws, pool, args, metrics, accounts, limit, checkpoints, enricher),
+            async_sync_historical(ws, pool, args, metrics, accounts, limit, checkpoints,
+                                  snapshot_since, touched),
+            async_sync_activities(ws, pool, args, metrics, accounts, limit, checkpoints,
+                                  activity_since, touched, security_ids),
         )
-        UPDATE dividends d
-        SET frequency = CASE
-            WHEN ag.avg_gap <= 45 THEN 'monthly'
-            WHEN ag.avg_gap <= 120 THEN 'quarterly'
-            WHEN ag.avg_gap <= 210 THEN 'semi-annual'
-            ELSE 'annual'
-        END
-        FROM avg_gaps ag
-        WHERE d.symbol = ag.symbol AND d."accountId" = ag."accountId"
-    """)
-    print("  → Frequencies updated")
 
+    # Activity-only securities are looked up after the positions stage,
+    # so a security is never fetched by both stages at once.
+    with metrics.stage("securities"):
+        print("\nEnriching securities...")
+        async with pool.connection() as conn:
+            writer = AsyncBulkWriter(conn, args.batch_size, metrics)
+            for security_data in await asyncio.to_thread(enricher.lookup, security_ids):
+                await writer.add("securities", security_data)
+            await writer.flush()
+        print(f"  → {enricher.looked_up} looked up, {enricher.skipped} skipped as fresh or already fetched")
+
+    with metrics.stage("dividends"):
+        print("\nDeriving dividends...")
+        account_ids = None if args.recompute_frequencies else touched_activity_accounts(touched)
+        started = time.perf_counter()
+        async with pool.connection() as conn:
+            cur = await conn.execute(*derive_dividends_query(account_ids, args.overlap_days))
+            record_derived_dividends(await cur.fetchall(), time.perf_counter() - started, touched, metrics)
+
+    counts = {
+        "accounts_count": len(accounts),
+        "positions_count": positions_count,
+        "snapshots_count": snapshots_count,
+        "activities_count": activities_count,
+        "dividends_count": dividends_count,
+    }
+    return counts, touched
 
-# ---------------------------------------------------------------------------
-# Main
-# ---------------------------------------------------------------------------
 
-def main():
-    parser = argparse.ArgumentParser(description="Sync Wealthsimple data to Neon PostgreSQL")
-    parser.add_argument("--totp", help="TOTP code for 2FA", type=str)
-    parser.add_argument("--email", help="WS email (overrides .env)", type=str)
-    parser.add_argument("--password", help="WS password (overrides .env)", type=str)
-    args = parser.parse_args()
+class AsyncPool:
+    """A psycopg 3 async connection pool and the event loop it lives on.
 
-    email = args.email or os.environ.get("WS_EMAIL")
-    password = args.password or os.environ.get("WS_PASSWORD")
+    The pool is bound to its loop, so both are kept together and reused for
+    every run of a daemon instead of reconnecting each time. Connections
+    are checked before being handed out, as Neon drops idle ones.
+    """
 
-    if not email or not password:
-        print("ERROR: WS_EMAIL and WS_PASSWORD must be set in .env or passed as arguments")
+    def __init__(self, url: str, max_size: int = 4):
+        self.loop = asyncio.new_event_loop()
+        self.pool = self.run(self._open(url, max_size))
+
+    @staticmethod
+    async def _open(url: str, max_size: int):
+        from psycopg_pool import AsyncConnectionPool
+
+        pool = AsyncConnectionPool(
+            url, min_size=1, max_size=max_size, open=False,
+            check=AsyncConnectionPool.check_connection,
+            kwargs={"keepalives": 1, "keepalives_idle": 60, "keepalives_interval": 10},
+        )
+        await pool.open()
+        return pool
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def close(self):
+        self.run(self.pool.close())
+        self.loop.close()
+
+
+def require_psycopg3():
+    """Exit unless psycopg 3 and its pool, which --engine async needs, are installed."""
+    if importlib.util.find_spec("psycopg") is None or importlib.util.find_spec("psycopg_pool") is None:
+        print("ERROR: psycopg 3 not found. Install with: pip install 'psycopg[binary]' 'psycopg-pool>=3.2'")
         sys.exit(1)
 
-    conn = get_db_connection()
-    cur = conn.cursor()
 
-    sync_id = create_sync_log(cur, "running")
-    conn.commit()
+def run_stages_async(ws, conn, args, metrics: SyncMetrics, checkpoints: Checkpoints,
+                     pool: AsyncPool | None = None) -> dict:
+    """Run the sync stages as overlapping coroutines on a psycopg 3 async pool.
 
+    WS calls run in worker threads, bounded by --concurrency. Each stage
+    writes through its own pooled connection and commits on its own. The
+    aggregates and any export run afterwards on ``conn``. Without a
+    ``pool``, one is opened for this run only.
+    """
+    owned = pool is None
+    if owned:
+        pool = AsyncPool(os.environ["DATABASE_URL"])
     try:
-        ws = ws_login(email, password, args.totp)
+        counts, touched = pool.run(_run_stages_async(ws, pool.pool, args, metrics, checkpoints))
+    finally:
+        if owned:
+            pool.close()
+    with metrics.stage("aggregates"):
+        refresh_aggregates(conn, touched, args.full, args.batch_size, metrics)
+    if args.export:
+        with metrics.stage("export"):
+            export_parquet(conn, args.export, touched, args.export_full, args.recompute_frequencies)
+    return counts
 
-        accounts = sync_accounts(ws, cur)
-        conn.commit()
 
-        positions_count = sync_positions(ws, cur, accounts)
-        conn.commit()
+# ---------------------------------------------------------------------------
+# Sync run
+# ---------------------------------------------------------------------------
 
-        snapshots_count = sync_historical(ws, cur, accounts)
-        conn.commit()
+def write_metrics_file(path: str | None, sync_id: str, metrics: SyncMetrics):
+    """Write the run's metrics to ``path`` as JSON, if one was given."""
+    if not path:
+        return
+    with open(path, "w") as f:
+        json.dump({"syncId": sync_id, **metrics.as_dict()}, f, indent=2)
+
+
+class WsSession:
+    """Hand out one WS client for the lifetime of the process.
+
+    The client is created on first use: a replay cassette, or a login that
+    may be recorded. With ``remember`` set, tokens are loaded from and
+    saved to the OS keyring, so a restarted daemon can resume its session
+    without a fresh TOTP code. A --totp code expires within a minute, so
+    only the first login uses it; later ones prompt for a new code.
+    """
+
+    def __init__(self, args, email: str | None, password: str | None, remember: bool = False):
+        self.args = args
+        self.email = email
+        self.password = password
+        self.remember = remember
+        self.totp = args.totp
+        self.ws = None
+        self.recorder = None
+
+    def client(self):
+        if self.ws is None:
+            args = self.args
+            if args.replay:
+                self.ws = ReplayClient(args.replay, args.replay_latency / 1000)
+            else:
+                tokens = load_session_tokens(self.email) if self.remember else None
+                totp, self.totp = self.totp, None
+                self.ws = ws_login(self.email, self.password, totp, tokens)
+                if args.record:
+                    self.ws = self.recorder = RecordingClient(self.ws, args.record)
+        return self.ws
+
+    def save(self):
+        """Persist the current tokens, which the client rotates as it refreshes them."""
+        if self.remember and self.ws is not None and not self.args.replay:
+            save_session_tokens(getattr(self.ws, "ws", self.ws), self.email)
+
+    def invalidate(self):
+        """Drop the client so the next run logs in again."""
+        self.close()
+        self.ws = None
+
+    def close(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+
+def run_stages(ws, conn, args, metrics: SyncMetrics, checkpoints: Checkpoints) -> dict:
+    """Run the sync stages one after another on ``conn``. Return the row counts.
+
+    Per-account stages skip the accounts ``checkpoints`` already completed.
+    """
+    cur = conn.cursor()
+    bulk = BulkWriter(conn.cursor(), args.batch_size, metrics)
+    writer = PipelineWriter(bulk, 4 * args.batch_size)
+    if args.concurrency > 1:
+        ws = PrefetchingClient(ws, args.concurrency)
 
-        activities_count, dividends_count = sync_activities(ws, cur, accounts)
-        conn.commit()
+    try:
+        with metrics.stage("accounts"):
+            accounts = sync_accounts(ws, writer)
+            writer.flush()
+            conn.commit()
+
+        snapshot_since = None if args.full else get_snapshot_cutoffs(cur)
+        if isinstance(ws, PrefetchingClient) and not args.backfill:
+            prefetch_account_data(ws, accounts, snapshot_since, checkpoints, args.page_size)
+
+        enricher = SecurityEnricher(ws, get_known_securities(cur, args.security_ttl), args.concurrency)
+        with metrics.stage("positions"):
+            positions_count = sync_positions(ws, writer, checkpoints.pending("positions", accounts),
+                                             enricher, checkpoints)
+            writer.flush()
+            conn.commit()
+
+        security_ids = set()
+        if args.backfill:
+            with metrics.stage("backfill"):
+                snapshots_count, activities_count, dividends_count = backfill(
+                    ws, writer, conn, accounts, args, security_ids,
+                )
+        else:
+            with metrics.stage("historical"):
+                snapshots_count = sync_historical(ws, writer, checkpoints.pending("historical", accounts),
+                                                  snapshot_since, checkpoints)
+                writer.flush()
+                conn.commit()
+
+            with metrics.stage("activities"):
+                since = None if args.full else get_activity_cutoffs(cur, args.overlap_days)
+                activities_count, dividends_count = sync_activities(
+                    ws, writer, checkpoints.pending("activities", accounts), since, security_ids, checkpoints,
+                    args.page_size,
+                )
+                writer.flush()
+                conn.commit()
+
+        with metrics.stage("securities"):
+            sync_securities(writer, enricher, security_ids)
+            writer.flush()
+            conn.commit()
+
+        with metrics.stage("dividends"):
+            account_ids = None if args.recompute_frequencies else touched_activity_accounts(bulk.touched)
+            derive_dividends(cur, account_ids, bulk.touched, metrics, args.overlap_days)
+            conn.commit()
+
+        with metrics.stage("aggregates"):
+            refresh_aggregates(conn, bulk.touched, args.full, args.batch_size, metrics)
+
+        if args.export:
+            with metrics.stage("export"):
+                export_parquet(conn, args.export, bulk.touched, args.export_full,
+                               args.recompute_frequencies)
+
+        return {
+            "accounts_count": len(accounts),
+            "positions_count": positions_count,
+            "snapshots_count": snapshots_count,
+            "activities_count": activities_count,
+            "dividends_count": dividends_count,
+        }
 
-        detect_dividend_frequency(cur)
-        conn.commit()
+    finally:
+        if isinstance(ws, PrefetchingClient):
+            ws.close()
+        writer.close()
+        cur.close()
+
+
+def run_sync(conn, args, get_client, profile: str | None = None,
+             async_pool: AsyncPool | None = None) -> str:
+    """Run every sync stage once and record it in sync_logs on ``conn``.
+
+    ``get_client`` returns the WS client and is timed as the login stage.
+    The log is tagged with ``profile`` when syncing one of several logins.
+    The async engine runs on ``async_pool`` when given.
+    Returns the sync ID. Failures are logged to sync_logs and then re-raised.
+    """
+    metrics = SyncMetrics()
+    cur = conn.cursor()
+
+    sync_id = None
+    if args.resume:
+        requested = None if args.resume == "latest" else args.resume
+        sync_id = find_resumable_sync(cur, requested, profile)
+        if not sync_id and requested:
+            print(f"ERROR: sync {requested} is not resumable "
+                  "(unknown, finished, still running or without checkpoints)")
+            sys.exit(1)
+        if not sync_id:
+            print("No failed sync to resume; starting a fresh one")
+    resumed = sync_id is not None
+    if resumed:
+        checkpoints = Checkpoints(sync_id, get_completed_checkpoints(cur, sync_id))
+        update_sync_log(cur, sync_id, status="running", error=None)
+        print(f"Resuming sync {sync_id}: {len(checkpoints.completed)} stage/account pairs already complete")
+    else:
+        sync_id = create_sync_log(cur, "running", profile)
+        checkpoints = Checkpoints(sync_id)
+    conn.commit()
 
+    try:
+        with metrics.stage("login"):
+            ws = get_client()
+        ws = InstrumentedClient(ws, metrics, args.metrics_bytes)
+        if not args.replay:
+            ws = RequestScheduler(
+                ws, args.rate, args.max_rate, args.concurrency,
+                args.max_retries, args.retry_budget, metrics,
+            )
+
+        if args.engine == "async":
+            counts = run_stages_async(ws, conn, args, metrics, checkpoints, async_pool)
+        else:
+            counts = run_stages(ws, conn, args, metrics, checkpoints)
+
+        logged = {**counts, **{f"{key}_count": n for key, n in metrics.write_totals().items()}}
+        if resumed:
+            logged = add_resumed_counts(cur, sync_id, logged)
         update_sync_log(
             cur,
             sync_id,
             status="success",
-            accounts_count=len(accounts),
-            positions_count=positions_count,
-            activities_count=activities_count,
-            snapshots_count=snapshots_count,
-            dividends_count=dividends_count,
+            **logged,
             completed_at=datetime.now(),
+            metrics=metrics.as_dict(),
         )
         conn.commit()
+        write_metrics_file(args.metrics_file, sync_id, metrics)
 
         print(f"\n{'='*50}")
-        print(f"Sync complete!")
-        print(f"  Accounts:   {len(accounts)}")
-        print(f"  Positions:  {positions_count}")
-        print(f"  Snapshots:  {snapshots_count}")
-        print(f"  Activities: {activities_count}")
-        print(f"  Dividends:  {dividends_count}")
+        print("Sync complete!")
+        print(f"  Accounts:   {counts['accounts_count']}")
+        print(f"  Positions:  {counts['positions_count']}")
+        print(f"  Snapshots:  {counts['snapshots_count']}")
+        print(f"  Activities: {counts['activities_count']}")
+        print(f"  Dividends:  {counts['dividends_count']}")
+        print("  Written:    " + ", ".join(f"{n} {key}" for key, n in metrics.write_totals().items()))
+        print("  Timings:    " + ", ".join(f"{k} {v:.2f}s" for k, v in metrics.stages.items()))
         print(f"{'='*50}")
+        return sync_id
 
     except Exception as e:
         print(f"\nERROR: {e}")
         traceback.print_exc()
+        conn.rollback()
         update_sync_log(
             cur,
             sync_id,
             status="error",
             error=str(e)[:500],
             completed_at=datetime.now(),
+            metrics=metrics.as_dict(),
         )
         conn.commit()
-        sys.exit(1)
+        write_metrics_file(args.metrics_file, sync_id, metrics)
+        raise
 
     finally:
         cur.close()
+
+
+# ---------------------------------------------------------------------------
+# Daemon
+# ---------------------------------------------------------------------------
+
+MARKET_TZ = ZoneInfo("America/Toronto")
+MARKET_OPEN = dt_time(9, 30)
+MARKET_CLOSE = dt_time(16, 0)
+
+
+def next_sync_delay(market_minutes: float, offhours_minutes: float,
+                    now: datetime | None = None) -> float:
+    """Seconds until the next scheduled sync.
+
+    Syncs run every ``market_minutes`` while the TSX is open and every
+    ``offhours_minutes`` otherwise. An overnight wait is cut short so the
+    first sync of the day lands right at the open.
+    """
+    now = now or datetime.now(MARKET_TZ)
+    if now.weekday() < 5 and MARKET_OPEN <= now.time() < MARKET_CLOSE:
+        return market_minutes * 60
+
+    next_open = datetime.combine(now.date(), MARKET_OPEN, MARKET_TZ)
+    if now >= next_open:
+        next_open += timedelta(days=1)
+    while next_open.weekday() >= 5:
+        next_open += timedelta(days=1)
+    return min(offhours_minutes * 60, (next_open - now).total_seconds())
+
+
+def run_daemon(args, session: WsSession):
+    """Sync on a schedule, reusing one WS session and warm connection pools."""
+    pool = get_db_pool()
+    async_pool = AsyncPool(os.environ["DATABASE_URL"]) if args.engine == "async" else None
+    print(f"Daemon started: every {args.market_interval:g} min during market hours, "
+          f"{args.offhours_interval:g} min otherwise")
+    try:
+        while True:
+            conn = checkout_connection(pool)
+            try:
+                run_sync(conn, args, session.client, async_pool=async_pool)
+                session.save()
+            except Exception:
+                # A failed run may mean a dead session; log in again next time.
+                session.invalidate()
+            finally:
+                pool.putconn(conn)
+
+            delay = next_sync_delay(args.market_interval, args.offhours_interval)
+            print(f"Next sync at {(datetime.now() + timedelta(seconds=delay)):%Y-%m-%d %H:%M}")
+            time.sleep(delay)
+    except KeyboardInterrupt:
+        print("\nDaemon stopped")
+    finally:
+        session.close()
+        pool.closeall()
+        if async_pool:
+            async_pool.close()
+
+
+# ---------------------------------------------------------------------------
+# Profiles
+# ---------------------------------------------------------------------------
+
+DEFAULT_MAX_PROFILES = 4
+
+
+def load_profiles(path: str) -> list[dict]:
+    """Read a profiles file: a JSON list of logins, each synced by its own worker.
+
+    Each entry has a unique ``name`` and an ``email``. ``password`` and
+    ``database_url`` may be given inline or read from the environment
+    variable named by ``password_env`` / ``database_url_env``; the
+    database defaults to DATABASE_URL. Each profile needs a database of its
+    own: the aggregate tables summarize a whole database, so two profiles
+    sharing one would refresh them over each other. ``replay`` syncs the
+    profile from a cassette instead of logging in.
+    """
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: Could not read profiles file {path}: {e}")
+        sys.exit(1)
+
+    profiles, names, databases = [], set(), {}
+    for i, entry in enumerate(entries if isinstance(entries, list) else []):
+        if not isinstance(entry, dict):
+            print(f"ERROR: profile {i + 1} in {path} is not an object")
+            sys.exit(1)
+        name = entry.get("name") or entry.get("email")
+        profile = {
+            "name": name,
+            "email": entry.get("email"),
+            "password": entry.get("password") or os.environ.get(entry.get("password_env", "")),
+            "database_url": (
+                entry.get("database_url")
+                or os.environ.get(entry.get("database_url_env", ""))
+                or os.environ.get("DATABASE_URL")
+            ),
+            "replay": entry.get("replay"),
+        }
+        problem = (
+            "no name or email" if not name
+            else f"duplicate name {name!r}" if name in names
+            else "no email or password" if not profile["replay"] and not (profile["email"] and profile["password"])
+            else "no database URL" if not profile["database_url"]
+            else f"same database as profile {databases[profile['database_url']]!r}"
+            if profile["database_url"] in databases
+            else None
+        )
+        if problem:
+            print(f"ERROR: profile {i + 1} in {path}: {problem}")
+            sys.exit(1)
+        names.add(name)
+        databases[profile["database_url"]] = name
+        profiles.append(profile)
+
+    if not profiles:
+        print(f"ERROR: {path} must be a JSON list of at least one profile")
+        sys.exit(1)
+    return profiles
+
+
+def prime_profile_sessions(profiles: list[dict]):
+    """Log in, one at a time, every profile without a saved session.
+
+    Workers cannot answer a TOTP prompt, so any login that needs one
+    happens here first and its tokens go to the keyring for the worker.
+    """
+    for profile in profiles:
+        if profile["replay"] or load_session_tokens(profile["email"]):
+            continue
+        print(f"[{profile['name']}] No saved session")
+        try:
+            save_session_tokens(ws_login(profile["email"], profile["password"]), profile["email"])
+        except Exception as e:
+            # The worker will fail the same way and record it in its sync log.
+            print(f"[{profile['name']}] Warning: login failed: {e}")
+
+
+class PrefixedStream:
+    """Write to ``stream`` with ``prefix`` at the start of every line.
+
+    Each line is written and flushed whole, so processes sharing a terminal
+    or pipe interleave by line rather than mid-line.
+    """
+
+    def __init__(self, stream, prefix: str):
+        self.stream = stream
+        self.prefix = prefix
+        self.pending = ""
+
+    def write(self, text: str):
+        *lines, self.pending = (self.pending + text).split("\n")
+        if lines:
+            self.stream.write("".join(f"{self.prefix}{line}\n" for line in lines))
+            self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            self.stream.write(f"{self.prefix}{self.pending}")
+            self.pending = ""
+        self.stream.flush()
+
+
+def profile_path(path: str | None, name: str) -> str | None:
+    """Give each profile its own copy of a per-run output file: run.json -> run.<name>.json."""
+    if not path:
+        return None
+    head, base = os.path.split(path)
+    stem, dot, ext = base.partition(".")
+    return os.path.join(head, f"{stem}.{name}{dot}{ext}")
+
+
+def sync_profile(profile: dict, args) -> dict:
+    """Worker process entry point: sync one profile into its own database."""
+    name = profile["name"]
+    sys.stdout = PrefixedStream(sys.stdout, f"[{name}] ")
+    sys.stderr = PrefixedStream(sys.stderr, f"[{name}] ")
+    os.environ["DATABASE_URL"] = profile["database_url"]
+    args = argparse.Namespace(**{
+        **vars(args),
+        "totp": None,
+        "replay": profile["replay"] or args.replay,
+        "record": profile_path(args.record, name),
+        "metrics_file": profile_path(args.metrics_file, name),
+        "export": os.path.join(args.export, name) if args.export else None,
+    })
+    logging.basicConfig(format="%(message)s", level=args.log_level)
+
+    started = time.perf_counter()
+    result = {"name": name, "status": "success", "sync_id": None, "error": None}
+    session = WsSession(args, profile["email"], profile["password"], remember=True)
+    conn = None
+    try:
+        conn = get_db_connection()
+        result["sync_id"] = run_sync(conn, args, session.client, profile=name)
+        session.save()
+    except (Exception, SystemExit) as e:
+        result["status"] = "error"
+        result["error"] = " ".join(str(e).split())[:200] or type(e).__name__
+    finally:
+        session.close()
+        if conn is not None:
+            conn.close()
+    result["elapsed_s"] = time.perf_counter() - started
+    sys.stdout.flush()
+    return result
+
+
+def run_profiles(args) -> bool:
+    """Sync every profile in ``args.profiles``, ``args.max_profiles`` at a time.
+
+    Each profile runs in its own process with its own WS session and
+    database connection, so one login failing leaves the others running.
+    Returns whether every profile succeeded.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    profiles = load_profiles(args.profiles)
+    if not args.replay:
+        prime_profile_sessions(profiles)
+
+    workers = max(1, min(args.max_profiles, len(profiles)))
+    print(f"Syncing {len(profiles)} profiles, {workers} at a time")
+    started = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(sync_profile, profile, args): profile for profile in profiles}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # The worker process itself died.
+                results.append({"name": futures[future]["name"], "status": "error",
+                                "sync_id": None, "error": " ".join(str(e).split())[:200],
+                                "elapsed_s": 0.0})
+
+    failed = [r for r in results if r["status"] != "success"]
+    width = max(len(r["name"]) for r in results)
+    print(f"\n{'='*50}")
+    print(f"Profiles: {len(results) - len(failed)} synced, {len(failed)} failed "
+          f"in {time.perf_counter() - started:.2f}s")
+    for r in sorted(results, key=lambda r: r["name"]):
+        detail = r["sync_id"] if r["status"] == "success" else r["error"]
+        print(f"  {r['name']:<{width}}  {r['status']:<7}  {r['elapsed_s']:>7.2f}s  {detail}")
+    print(f"{'='*50}")
+    return not failed
+
+
+# ---------------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync Wealthsimple data to Neon PostgreSQL")
+    parser.add_argument("--totp", help="TOTP code for 2FA", type=str)
+    parser.add_argument("--email", help="WS email (overrides .env)", type=str)
+    parser.add_argument("--password", help="WS password (overrides .env)", type=str)
+    parser.add_argument(
+        "--batch-size", help=f"Rows per bulk upsert (default {DEFAULT_BATCH_SIZE})",
+        type=int, default=DEFAULT_BATCH_SIZE,
+    )
+    parser.add_argument(
+        "--page-size", help=f"Activities requested per API page (default {ACTIVITY_PAGE_SIZE})",
+        type=int, default=ACTIVITY_PAGE_SIZE,
+    )
+    parser.add_argument(
+        "--concurrency", help="Parallel API calls across accounts and stages (default 1)",
+        type=int, default=1,
+    )
+    parser.add_argument(
+        "--rate", help="Initial API requests per second; adapts up to --max-rate (default 2)",
+        type=float, default=2.0,
+    )
+    parser.add_argument(
+        "--max-rate", help="Ceiling for the adaptive API request rate (default 10)",
+        type=float, default=10.0,
+    )
+    parser.add_argument(
+        "--max-retries", help="Retries per API call on 429/5xx/network errors (default 5)",
+        type=int, default=5,
+    )
+    parser.add_argument(
+        "--retry-budget", help="Total API retries allowed per sync run (default 50)",
+        type=int, default=50,
+    )
+    parser.add_argument(
+        "--security-ttl", help="Hours before a security's metadata is looked up again (default 24)",
+        type=float, default=24.0,
+    )
+    parser.add_argument(
+        "--full", help="Resync full activity and snapshot history instead of only recent days",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--backfill", help="Fetch each account's whole history in date windows, resuming unfinished ones",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--backfill-chunk-days", help="Days per backfill window (default 90)",
+        type=int, default=90,
+    )
+    parser.add_argument(
+        "--backfill-from", help=f"Start date for accounts without an opening date (default {BACKFILL_EARLIEST})",
+        type=str, default=BACKFILL_EARLIEST,
+    )
+    parser.add_argument(
+        "--resume", help="Rerun only the stage/account pairs a sync left failed or unfinished "
+                         f"(default: the latest such sync from the last {RESUME_MAX_AGE_HOURS}h, "
+                         "else a fresh sync)",
+        nargs="?", const="latest", metavar="SYNC_ID",
+    )
+    parser.add_argument(
+        "--overlap-days",
+        help=f"Days before the latest stored activity to resync (default {DEFAULT_OVERLAP_DAYS})",
+        type=int, default=DEFAULT_OVERLAP_DAYS,
+    )
+    parser.add_argument("--record", help="Write every API response to this .ndjson.gz cassette", type=str)
+    parser.add_argument("--replay", help="Sync from a recorded cassette instead of logging in", type=str)
+    parser.add_argument(
+        "--replay-latency", help="Milliseconds to sleep per replayed API call (default 0)",
+        type=float, default=0.0,
+    )
+    parser.add_argument(
+        "--recompute-frequencies", help="Rederive every account's dividends and their frequencies from "
+                                        "stored activities, not just accounts with new activities",
+        action="store_true",
+    )
+    parser.add_argument("--metrics-file", help="Also write this run's metrics as JSON to a file", type=str)
+    parser.add_argument(
+        "--metrics-bytes", help="Also measure the size of every API response (re-encodes each one)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--export", help="Also write synced tables to Parquet under this directory, "
+                         "rewriting only the account/year partitions this run touched",
+        type=str, metavar="DIR",
+    )
+    parser.add_argument(
+        "--export-full", help="With --export, rewrite every partition",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--quotes-only", help="Only reprice held securities and positions from batched quotes "
+                              "(Yahoo's previous daily close, not a live quote); no Wealthsimple login",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--quotes-file", help="With --quotes-only, read quotes from this JSON file instead of Yahoo Finance",
+        type=str,
+    )
+    parser.add_argument(
+        "--quote-batch-size", help=f"Symbols per quote request (default {QUOTE_BATCH_SIZE})",
+        type=int, default=QUOTE_BATCH_SIZE,
+    )
+    parser.add_argument(
+        "--quote-ttl", help=f"Minutes a cached quote stays fresh (default {QUOTE_TTL_MINUTES})",
+        type=float, default=QUOTE_TTL_MINUTES,
+    )
+    parser.add_argument(
+        "--log-level", help="DEBUG prints every synced row (default INFO)",
+        choices=["DEBUG", "INFO", "WARNING"], default="INFO",
+    )
+    parser.add_argument(
+        "--engine", help="sync: sequential stages on psycopg2 (default); "
+                         "async: overlapping stages on psycopg 3",
+        choices=["sync", "async"], default="sync",
+    )
+    parser.add_argument(
+        "--profiles", help="Sync every login in this JSON profiles file, each in its own process",
+        type=str,
+    )
+    parser.add_argument(
+        "--max-profiles", help=f"Profiles synced at the same time (default {DEFAULT_MAX_PROFILES})",
+        type=int, default=DEFAULT_MAX_PROFILES,
+    )
+    parser.add_argument(
+        "--daemon", help="Keep running and sync on a schedule with a persistent session and DB pool",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--market-interval", help="Daemon minutes between syncs during market hours (default 15)",
+        type=float, default=15,
+    )
+    parser.add_argument(
+        "--offhours-interval", help="Daemon minutes between syncs outside market hours (default 120)",
+        type=float, default=120,
+    )
+    args = parser.parse_args()
+
+    email = args.email or os.environ.get("WS_EMAIL")
+    password = args.password or os.environ.get("WS_PASSWORD")
+
+    if args.quotes_only:
+        if args.daemon or args.profiles or args.resume:
+            print("ERROR: --quotes-only runs on its own; drop --daemon, --profiles and --resume")
+            sys.exit(1)
+        provider = FileQuoteProvider(args.quotes_file) if args.quotes_file else YahooQuoteProvider()
+        conn = get_db_connection()
+        try:
+            refresh_quotes(conn, provider, args.quote_batch_size, args.quote_ttl, args.batch_size)
+        finally:
+            conn.close()
+        return
+
+    if not args.replay and not args.profiles and (not email or not password):
+        print("ERROR: WS_EMAIL and WS_PASSWORD must be set in .env or passed as arguments")
+        sys.exit(1)
+
+    if args.resume and args.daemon:
+        print("ERROR: --resume is a one-off run; drop --daemon")
+        sys.exit(1)
+
+    if args.profiles and args.daemon:
+        print("ERROR: --profiles is a one-off run; schedule it instead of using --daemon")
+        sys.exit(1)
+
+    if args.backfill and args.engine == "async":
+        print("ERROR: --backfill runs on the sync engine; drop --engine async")
+        sys.exit(1)
+
+    if args.export:
+        require_pyarrow()
+
+    if args.engine == "async":
+        require_psycopg3()
+
+    if args.profiles:
+        if not run_profiles(args):
+            sys.exit(1)
+        return
+
+    logging.basicConfig(format="%(message)s", level=args.log_level)
+
+    session = WsSession(args, email, password, remember=args.daemon)
+    if args.daemon:
+        run_daemon(args, session)
+        return
+
+    conn = get_db_connection()
+    try:
+        run_sync(conn, args, session.client)
+    except Exception:
+        sys.exit(1)
+    finally:
+        session.close()
         conn.close()
 
 